@@ -0,0 +1,67 @@
+import os
+import random
+import sys
+import time
+
+import Levenshtein
+
+from common import install_realm, make_entries, request_context, server
+from duplicates import make_upload
+
+
+def pairwise_get_duplicates(state, entry):
+    """get_duplicates() before batch scoring, used as the reference."""
+    candidates = state.dups.candidates(entry, state.search)
+    if candidates is None:
+        candidates = state.db.entries
+    dups = []
+    for e in candidates:
+        dist = 0
+        fields = set(e.keys())
+        fields.update(entry.keys())
+        length = 0
+        exact = e["ID"] == entry["ID"]
+        for field in fields:
+            if field in e and field in entry:
+                dist += Levenshtein.distance(e[field], entry[field])
+                length += max(len(e[field]), len(entry[field]))
+        if (exact and sorted(e.keys()) != sorted(entry.keys())) or ((dist < max(5, length * 0.1) or exact) and dist > 0):
+            dups.append((dist, entry["ID"], e))
+    return dups
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else (os.cpu_count() or 1)
+    print("%10s %8s %16s %16s %16s %12s" % ("entries", "upload", "pairwise [1/s]", "batch [1/s]",
+                                            "%d procs [1/s]" % workers, "mismatches"))
+    for (count, upload_size) in [(5000, 2000), (20000, 5000), (50000, 10000)]:
+        realm = "batch%d" % count
+        entries = make_entries(count, duplicate_rate=0.05, typo_rate=0.01)
+        install_realm(realm, entries)
+        rnd = random.Random(count)
+        upload = [entry for _ in range(upload_size // 200) for entry in make_upload(rnd, entries)]
+        with request_context(realm):
+            state = server.realm_state()
+            start = time.perf_counter()
+            reference = [pairwise_get_duplicates(state, entry) for entry in upload]
+            pairwise = time.perf_counter() - start
+
+            server.duplicate_workers = 1
+            start = time.perf_counter()
+            batch = server.batch_duplicates(upload, state)
+            single = time.perf_counter() - start
+
+            server.duplicate_workers = workers
+            server.parallel_duplicates = 0
+            server.duplicate_process_pool()
+            start = time.perf_counter()
+            parallel = server.batch_duplicates(upload, state)
+            multi = time.perf_counter() - start
+            server.parallel_duplicates = 20000
+        mismatches = sum(1 for (a, b, c) in zip(reference, batch, parallel) if not (a == b == c))
+        print("%10d %8d %16.0f %16.0f %16.0f %12d" % (count, len(upload), len(upload) / pairwise, len(upload) / single,
+                                                   len(upload) / multi, mismatches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import io
+import json
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bibtexparser
+
+from common import make_entries, server, use_repository, write_realm
+
+TOKEN = "bench"
+
+
+def payload(realm, entries, method):
+    """The request that sends entries like /v1/update with one JSON body, or streamed to /v1/import."""
+    if method == "update":
+        body = json.dumps({"entries": entries, "token": TOKEN, "realm": realm})
+        return "/v1/update", body.encode("utf-8")
+    if method == "ndjson":
+        body = "".join(json.dumps(entry) + "\n" for entry in entries)
+    else:
+        db = bibtexparser.bibdatabase.BibDatabase()
+        db.entries = entries
+        body = bibtexparser.dumps(db)
+    return "/v1/import/%s/%s?format=%s" % (TOKEN, realm, method), body.encode("utf-8")
+
+
+def upload(client, request):
+    path, body = request
+    response = client.post(path, data=io.BytesIO(body), content_type="application/json" if path == "/v1/update" else None)
+    if path == "/v1/update":
+        return response.json["success"] or response.json["reason"] == "duplicate"
+    return json.loads(response.get_data().splitlines()[-1])["success"]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    root = tempfile.mkdtemp(prefix="bibtool-import-")
+    use_repository(root)
+    server.no_commit = True
+    # the journal is folded at the end, compaction in the background would be measured as well
+    server.compact_delay = 3600
+    server.compact_size = 1 << 40
+    client = server.app.test_client()
+    entries = make_entries(count, duplicate_rate=0.02)
+    print("%10s %10s %12s %16s %18s" % ("entries", "method", "seed [s]", "re-upload [s]", "re-upload [MB]"))
+    try:
+        for method in ["update", "ndjson", "bibtex"]:
+            realm = "import-%s" % method
+            write_realm(root, realm, [], token=TOKEN)
+            request = payload(realm, entries, method)
+            start = time.perf_counter()
+            ok = upload(client, request)
+            seed = time.perf_counter() - start
+            # uploading the same entries again only parses and compares them
+            start = time.perf_counter()
+            ok = upload(client, request) and ok
+            again = time.perf_counter() - start
+            tracemalloc.start()
+            ok = upload(client, request) and ok
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("%10d %10s %12.2f %16.2f %18.1f%s" % (count, method, seed, again, peak / 1024.0 / 1024.0, "" if ok else " (failed)"))
+    finally:
+        server.compact_journals()
+        server.flush_snapshots()
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bibtexparser
+import server
+
+NAMES = ["Schwarz", "Gruss", "Lipp", "Kocher", "Mangard", "Genkin", "Yarom", "Canella",
+         "Weber", "Maurice", "Horn", "Fogh", "Prescher", "Haas", "Hamburg", "Walter"]
+COMMON = ["a", "the", "of", "for", "on", "in", "and", "with", "towards", "using", "via"]
+
+
+def make_vocabulary(rnd, count):
+    syllables = ["ca", "che", "at", "tack", "side", "chan", "nel", "mem", "ory", "ker", "spec",
+                 "ula", "tive", "ex", "ecu", "tion", "tim", "ing", "ana", "lys", "is", "se", "cure",
+                 "hard", "ware", "pro", "ces", "sor", "leak", "age", "iso", "la", "net", "work"]
+    words = set()
+    while len(words) < count:
+        words.add("".join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4))))
+    return sorted(words)
+
+
+VOCABULARY = make_vocabulary(random.Random(0), 5000)
+SURNAMES = NAMES + [w.capitalize() for w in VOCABULARY[::10]]
+
+
+def skewed_choice(rnd, words):
+    # few words are frequent and most are rare, as in real titles and author lists
+    return words[int(len(words) * rnd.random() ** 2)]
+
+
+def make_entry(rnd, idx):
+    author = " and ".join("%s, %s." % (skewed_choice(rnd, SURNAMES), chr(65 + rnd.randrange(26))) for _ in range(rnd.randint(1, 5)))
+    title = " ".join(rnd.choice(COMMON) if rnd.random() < 0.25 else skewed_choice(rnd, VOCABULARY) for _ in range(rnd.randint(4, 12))).capitalize()
+    year = str(rnd.randint(1990, 2024))
+    return {
+        "ENTRYTYPE": rnd.choice(["article", "inproceedings", "misc"]),
+        "ID": "%s%s%s%d" % (author.split(",")[0].lower(), year, title.split(" ")[0].lower(), idx),
+        "title": title,
+        "author": author,
+        "year": year,
+        "doi": "10.%d/%d.%d" % (rnd.randint(1000, 9999), int(year), idx),
+    }
+
+
+def make_typo(rnd, text):
+    if len(text) == 0:
+        return text
+    pos = rnd.randrange(len(text))
+    kind = rnd.randrange(3)
+    if kind == 0:
+        return text[:pos] + text[pos + 1:]
+    if kind == 1:
+        return text[:pos] + rnd.choice("abcdefghijklmnopqrstuvwxyz") + text[pos:]
+    return text[:pos] + rnd.choice("abcdefghijklmnopqrstuvwxyz") + text[pos + 1:]
+
+
+def make_variant(rnd, entry, typos=2):
+    """A near-duplicate of entry, as produced by copying and editing it in another paper."""
+    variant = dict(entry)
+    for _ in range(typos):
+        field = rnd.choice([f for f in variant if f != "ENTRYTYPE"])
+        variant[field] = make_typo(rnd, variant[field])
+    if rnd.random() < 0.2 and "doi" in variant:
+        del variant["doi"]
+    return variant
+
+
+def make_entries(count, seed=0, duplicate_rate=0.0, typos=2, typo_rate=0.0):
+    """count entries, of which about duplicate_rate are near-duplicates of earlier ones with
+    the given number of typos, and about typo_rate of the others have a typo in the title."""
+    rnd = random.Random(seed)
+    entries = []
+    for idx in range(count):
+        if len(entries) > 0 and rnd.random() < duplicate_rate:
+            entries.append(make_variant(rnd, rnd.choice(entries), typos))
+        else:
+            entries.append(make_entry(rnd, idx))
+            if typo_rate > 0 and rnd.random() < typo_rate:
+                entries[-1]["title"] = make_typo(rnd, entries[-1]["title"])
+    return entries
+
+
+def install_realm(realm, entries):
+    """Load a generated realm directly into the server state, bypassing the git checkout."""
+    server.tokens = False
+    server.no_commit = True
+    server.policies = []
+    db = bibtexparser.bibdatabase.BibDatabase()
+    db.entries = entries
+    server.repo[realm] = None
+    server.token_db[realm] = {}
+    server.realms[realm] = server.RealmState(db)
+
+
+def write_realm(root, realm, entries, token="bench", commit=False):
+    """Lays out a realm the way the server reads it: <root>/<realm>/main.bib and a tokens.json
+    with a token that has all permissions, optionally as a git repository."""
+    realm_dir = os.path.join(root, realm)
+    os.makedirs(realm_dir, exist_ok=True)
+    db = bibtexparser.bibdatabase.BibDatabase()
+    db.entries = entries
+    with open(os.path.join(realm_dir, "main.bib"), "w") as f:
+        f.write(bibtexparser.dumps(db))
+    with open(os.path.join(realm_dir, "tokens.json"), "w") as f:
+        json.dump({token: {permission: True for permission in ["search", "read", "write", "delete", "force", "import"]}}, f, indent=4)
+    if commit:
+        import git
+        repository = git.Repo.init(realm_dir)
+        repository.index.add(["main.bib", "tokens.json"])
+        repository.index.commit("Generated realm")
+    return realm_dir
+
+
+def use_repository(root):
+    """Points the server at generated realms, as if it was started with root as repo path."""
+    server.repo_path = root
+    server.repo_name = "main.bib"
+    server.cache_path = os.path.join(root, ".cache")
+    server.tokens = True
+    server.policies = []
+
+
+def request_context(realm):
+    return server.app.test_request_context("/?realm=%s" % realm)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
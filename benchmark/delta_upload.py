@@ -0,0 +1,41 @@
+import copy
+import json
+import random
+import time
+
+from common import install_realm, make_entries, server
+
+REALM_SIZE = 20000
+
+
+def post(client, path, data):
+    body = json.dumps(data)
+    start = time.perf_counter()
+    response = client.post(path, data=body, content_type="application/json")
+    return response.json, len(body), time.perf_counter() - start
+
+
+def main():
+    realm = "delta"
+    entries = make_entries(REALM_SIZE, duplicate_rate=0.01)
+    install_realm(realm, entries)
+    client = server.app.test_client()
+    print("%10s %14s %14s %12s %12s %10s" % ("local", "full [KB]", "delta [KB]", "full [ms]", "delta [ms]", "same"))
+    for count in [100, 800, 5000]:
+        rnd = random.Random(count)
+        local = copy.deepcopy(rnd.sample(entries, count))
+        local[0]["title"] += " (extended version)"
+
+        full, full_bytes, full_time = post(client, "/v1/update", {"entries": local, "token": "", "realm": realm})
+
+        hashes = [[entry["ID"], server.entry_hash(entry)] for entry in local]
+        changed, hash_bytes, hash_time = post(client, "/v1/changed", {"hashes": hashes, "token": "", "realm": realm})
+        upload = [entry for entry in local if entry["ID"] in set(changed["changed"])]
+        delta, upload_bytes, upload_time = post(client, "/v1/update", {"entries": upload, "token": "", "realm": realm})
+
+        print("%10d %14.1f %14.1f %12.2f %12.2f %10s" % (count, full_bytes / 1024.0, (hash_bytes + upload_bytes) / 1024.0,
+              full_time * 1000, (hash_time + upload_time) * 1000, full == delta))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import random
+import sys
+import time
+
+import Levenshtein
+
+from common import install_realm, make_entries, make_entry, make_variant, request_context, server
+
+UPLOAD = 200
+
+
+def linear_get_duplicates(realm, entry):
+    """get_duplicates() before the blocking index, used as the reference."""
+    dups = []
+    for e in server.realms[realm].db.entries:
+        dist = 0
+        fields = set(e.keys())
+        fields.update(entry.keys())
+        length = 0
+        exact = e["ID"] == entry["ID"]
+        for field in fields:
+            if field in e and field in entry:
+                dist += Levenshtein.distance(e[field], entry[field])
+                length += max(len(e[field]), len(entry[field]))
+        if (exact and sorted(e.keys()) != sorted(entry.keys())) or ((dist < max(5, length * 0.1) or exact) and dist > 0):
+            dups.append((dist, entry["ID"], e))
+    return dups
+
+
+def make_upload(rnd, entries):
+    """A client upload: unchanged entries, edited copies, same-key changes and new entries."""
+    upload = []
+    for idx in range(UPLOAD):
+        kind = rnd.random()
+        if kind < 0.4:
+            upload.append(dict(rnd.choice(entries)))
+        elif kind < 0.7:
+            upload.append(make_variant(rnd, rnd.choice(entries), rnd.randint(1, 6)))
+        elif kind < 0.8:
+            entry = dict(rnd.choice(entries))
+            entry["note"] = "local note"
+            upload.append(entry)
+        else:
+            upload.append(make_entry(rnd, 10 ** 7 + idx))
+    return upload
+
+
+# uploads with typos in short fields, each a duplicate of an entry of CASES_REALM
+CASES_REALM = [
+    {"ENTRYTYPE": "inproceedings", "ID": "kocher2019", "title": "Spectre Attacks Exploiting Speculative Execution", "author": "Kocher, Paul", "year": "2019"},
+    {"ENTRYTYPE": "inproceedings", "ID": "lipp2018", "title": "Meltdown", "author": "Lipp, Moritz", "year": "2018"},
+]
+CASES = [
+    {"ENTRYTYPE": "inproceedings", "ID": "kocher2019a", "title": "Spectr Atacks Exploitng Speculative Execution", "author": "Kocher, P.", "year": "2019"},
+    {"ENTRYTYPE": "inproceedings", "ID": "lipp2018a", "title": "Meltdwn", "author": "Lip, Moritz", "year": "2018"},
+]
+
+
+def compare(realm, upload):
+    """The number of uploaded entries for which get_duplicates() differs from the reference."""
+    with request_context(realm):
+        reference = [linear_get_duplicates(realm, entry) for entry in upload]
+        blocked = [server.get_duplicates(entry) for entry in upload]
+    return sum(1 for (a, b) in zip(reference, blocked) if a != b)
+
+
+def main():
+    install_realm("cases", [dict(entry) for entry in CASES_REALM])
+    failed = compare("cases", CASES)
+    print("%d of %d typo cases differ from the reference" % (failed, len(CASES)))
+    print("%10s %14s %14s %10s %12s" % ("entries", "linear [s]", "blocked [s]", "speedup", "mismatches"))
+    for count in [1000, 5000, 20000]:
+        realm = "dups%d" % count
+        entries = make_entries(count, duplicate_rate=0.05)
+        install_realm(realm, entries)
+        upload = make_upload(random.Random(count), entries)
+        with request_context(realm):
+            start = time.perf_counter()
+            reference = [linear_get_duplicates(realm, entry) for entry in upload]
+            linear = time.perf_counter() - start
+            start = time.perf_counter()
+            blocked = [server.get_duplicates(entry) for entry in upload]
+            indexed = time.perf_counter() - start
+        mismatches = sum(1 for (a, b) in zip(reference, blocked) if a != b)
+        print("%10d %14.2f %14.2f %9.0fx %12d" % (count, linear, indexed, linear / indexed, mismatches))
+        failed += mismatches
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import argparse
+import time
+
+from common import make_entries, write_realm
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a realm with synthetic bibliography entries")
+    parser.add_argument("path", help="Repository path of the server, the realm is created in a folder below")
+    parser.add_argument("--realm", default="bench", help="Name of the realm")
+    parser.add_argument("--entries", type=int, default=10000, help="Number of entries")
+    parser.add_argument("--duplicate-rate", type=float, default=0.02, help="Fraction of near-duplicate entries")
+    parser.add_argument("--typos", type=int, default=2, help="Typos in each near-duplicate")
+    parser.add_argument("--typo-rate", type=float, default=0.01, help="Fraction of other entries with a typo in the title")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--token", default="bench", help="Token with all permissions")
+    parser.add_argument("--git", action="store_true", help="Commit the realm to a new git repository")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    entries = make_entries(args.entries, seed=args.seed, duplicate_rate=args.duplicate_rate, typos=args.typos, typo_rate=args.typo_rate)
+    realm_dir = write_realm(args.path, args.realm, entries, token=args.token, commit=args.git)
+    print("%d entries written to %s in %.1f s" % (len(entries), realm_dir, time.perf_counter() - start))
+    print("Start the server with: python3 server.py %s main.bib" % args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import random
+import shutil
+import sys
+import tempfile
+
+from common import make_entries, make_entry, make_typo, server, use_repository, write_realm
+
+TOKEN = "bench"
+
+
+def restart(realm):
+    """The state the server reads after it was killed: main.bib and the journal."""
+    with server.realm_usage_lock:
+        server.realms.pop(realm, None)
+    with server.journals_lock:
+        server.journals.pop(realm, None)
+    state = server.read_realm_state(realm)
+    # the compaction scheduled by the replay finds the realm unloaded and does nothing
+    with server.journals_lock:
+        server.journals.pop(realm, None)
+    return state
+
+
+def normalized(state):
+    """The entries of state as they are written to main.bib and read again."""
+    return server.parse_bibtex(server.bib_to_bibtex(state)).entries
+
+
+def write(client, method, realm, entry, key=None):
+    key = key or entry["ID"]
+    if method == "DELETE":
+        result = client.delete("/v1/entry/%s/%s?realm=%s" % (key, TOKEN, realm)).json
+    else:
+        result = client.open("/v1/entry/%s" % key, method=method, json={"entry": entry, "token": TOKEN, "realm": realm}).json
+    if not result["success"]:
+        raise Exception("%s %s failed: %s" % (method, key, result))
+
+
+def check_case(client, realm):
+    """An entry added with an entry type the parser normalizes, folded into main.bib, and
+    changed afterwards: the change must survive a crash."""
+    write(client, "POST", realm, {"ENTRYTYPE": "Article", "ID": "k1", "title": "Before the crash"})
+    server.compact_journal(realm)
+    write(client, "PUT", realm, {"ENTRYTYPE": "article", "ID": "k1", "title": "After the compaction"})
+    state = restart(realm)
+    return state.lookup("k1") is not None and state.lookup("k1")["title"] == "After the compaction"
+
+
+def random_writes(rnd, client, realm, count, compaction_rate):
+    """count random additions, changes and deletions, with entry types in upper case and
+    changes that give an entry the key of another one, and compactions in between. Returns
+    the number of compactions."""
+    compactions = 0
+    for idx in range(count):
+        entries = server.realms[realm].db.entries
+        kind = rnd.random()
+        if kind < 0.3 or len(entries) < 10:
+            entry = make_entry(rnd, 10 ** 6 + idx)
+            entry["ENTRYTYPE"] = entry["ENTRYTYPE"].capitalize()
+            write(client, "POST", realm, entry)
+        elif kind < 0.8:
+            entry = dict(rnd.choice(entries))
+            key = entry["ID"]
+            entry["title"] = make_typo(rnd, entry["title"])
+            entry["ENTRYTYPE"] = entry["ENTRYTYPE"].upper()
+            if rnd.random() < 0.1:
+                # afterwards, several entries have this key
+                entry["ID"] = rnd.choice(entries)["ID"]
+            write(client, "PUT", realm, entry, key)
+        else:
+            write(client, "DELETE", realm, rnd.choice(entries))
+        if rnd.random() < compaction_rate:
+            server.compact_journal(realm)
+            compactions += 1
+    return compactions
+
+
+def main():
+    root = tempfile.mkdtemp(prefix="bibtool-journal-")
+    use_repository(root)
+    server.no_commit = True
+    # compactions only happen where this script asks for them
+    server.compact_delay = 3600
+    client = server.app.test_client()
+    try:
+        write_realm(root, "case", make_entries(20))
+        failed = 0 if check_case(client, "case") else 1
+        print("a change after a compaction %s the crash" % ("survives" if failed == 0 else "is lost after"))
+        print("%10s %8s %12s %12s" % ("entries", "writes", "compactions", "identical"))
+        for (count, writes) in [(1000, 200), (5000, 1000)]:
+            realm = "journal%d" % count
+            entries = make_entries(count, duplicate_rate=0.05)
+            # entries that share a key
+            for entry in random.Random(count).sample(entries, count // 50):
+                entries.append(dict(entry, title=entry["title"] + " (extended)"))
+            write_realm(root, realm, entries)
+            # loads the realm
+            client.get("/v1/version?token=%s&realm=%s" % (TOKEN, realm))
+            compactions = random_writes(random.Random(count), client, realm, writes, 0.02)
+            expected = normalized(server.realms[realm])
+            state = restart(realm)
+            identical = normalized(state) == expected
+            print("%10d %8d %12d %12s" % (count, writes, compactions, identical))
+            failed += int(not identical)
+    finally:
+        shutil.rmtree(root)
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import random
+
+from common import install_realm, make_entries, request_context, server, timeit
+
+LOOKUPS = 300
+
+
+def linear_entry_by_key(realm, key):
+    for entry in server.realms[realm].db.entries:
+        if entry["ID"] == key:
+            return entry
+    return None
+
+
+def main():
+    print("%10s %14s %14s %10s" % ("entries", "linear [ms]", "index [ms]", "speedup"))
+    for count in [1000, 10000, 100000]:
+        realm = "bench%d" % count
+        entries = make_entries(count)
+        install_realm(realm, entries)
+        rnd = random.Random(1)
+        keys = [rnd.choice(entries)["ID"] for _ in range(LOOKUPS)]
+        with request_context(realm):
+            linear = timeit(lambda: [linear_entry_by_key(realm, key) for key in keys])
+            indexed = timeit(lambda: [server.entry_by_key(key) for key in keys])
+        print("%10d %14.2f %14.2f %9.0fx" % (count, linear * 1000, indexed * 1000, linear / indexed))
+
+
+if __name__ == "__main__":
+    main()
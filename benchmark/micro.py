@@ -0,0 +1,82 @@
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from common import (make_entries, make_entry, make_typo, make_variant, percentile, request_context, server,
+                    use_repository, write_realm)
+
+SAMPLES = 200
+
+
+def measure(func, args):
+    """Latencies of func for each of the arguments, in seconds."""
+    times = []
+    for arg in args:
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark(root, count):
+    realm = "micro%d" % count
+    rnd = random.Random(count)
+    entries = make_entries(count, duplicate_rate=0.02, typo_rate=0.01)
+    write_realm(root, realm, entries)
+    client = server.app.test_client()
+    with request_context(realm):
+        server.ensure_realm_loaded(realm)
+
+    uploads = [make_variant(rnd, rnd.choice(entries), rnd.randint(1, 4)) if rnd.random() < 0.5 else make_entry(rnd, 10 ** 7 + idx)
+               for idx in range(SAMPLES)]
+    queries = [" ".join(rnd.choice(entries)["title"].split(" ")[:2]) for _ in range(SAMPLES)]
+    queries = [q for q in queries if all(len(part) >= 3 for part in q.split(" "))] or ["the"]
+    keys = [make_typo(rnd, rnd.choice(entries)["ID"]) for _ in range(SAMPLES)]
+    new_entries = [make_entry(rnd, 2 * 10 ** 7 + idx) for idx in range(SAMPLES // 10)]
+
+    def duplicates(entry):
+        with request_context(realm):
+            server.get_duplicates(entry)
+
+    def search(query):
+        client.get("/v1/search/%s/bench/%s" % (query, realm)).get_data()
+
+    def suggest(key):
+        client.get("/v1/suggest/%s/bench/%s" % (key, realm)).get_data()
+
+    def save(entry):
+        with request_context(realm):
+            with server.write_state() as state:
+                state.add(entry)
+                server.save_bib("Added %s" % entry["ID"], "bench")
+
+    return [
+        ("get_duplicates", measure(duplicates, uploads)),
+        ("search_entry", measure(search, queries)),
+        ("suggest_entry", measure(suggest, keys)),
+        ("entry_to_bibtex", measure(server.entry_to_bibtex, entries[:SAMPLES])),
+        ("save_bib", measure(save, new_entries)),
+    ]
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    root = tempfile.mkdtemp(prefix="bibtool-micro-")
+    use_repository(root)
+    server.no_commit = True
+    print("%10s %16s %8s %12s %12s %12s" % ("entries", "operation", "calls", "mean [ms]", "p50 [ms]", "p99 [ms]"))
+    try:
+        for count in sizes:
+            for (name, times) in benchmark(root, count):
+                print("%10d %16s %8d %12.3f %12.3f %12.3f" % (count, name, len(times), 1000 * sum(times) / len(times),
+                      1000 * percentile(times, 50), 1000 * percentile(times, 99)))
+    finally:
+        server.compact_journals()
+        server.flush_snapshots()
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
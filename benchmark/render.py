@@ -0,0 +1,36 @@
+import random
+
+import bibtexparser
+
+from common import install_realm, make_entries, make_entry, request_context, server, timeit
+
+
+def main():
+    print("%10s %14s %14s %10s %10s" % ("entries", "dumps [ms]", "cached [ms]", "speedup", "identical"))
+    for count in [1000, 10000, 50000]:
+        realm = "render%d" % count
+        entries = make_entries(count, duplicate_rate=0.01)
+        install_realm(realm, entries)
+        db = server.realms[realm].db
+        db.comments = ["generated by benchmark/render.py"]
+        db.preambles = ["\\\\newcommand{\\\\noop}[1]{}"]
+        db.strings["conf"] = "Benchmark Conference"
+        rnd = random.Random(count)
+        with request_context(realm):
+            server.bib_to_bibtex(server.realm_state())
+            identical = server.bib_to_bibtex(server.realm_state()) == bibtexparser.dumps(db)
+
+            def single_write():
+                # what compact_journal() does after one changed entry
+                with server.write_state() as state:
+                    state.replace(rnd.choice(state.db.entries), make_entry(rnd, rnd.randrange(count)))
+                    server.bib_to_bibtex(state)
+            full = timeit(lambda: bibtexparser.dumps(db), repeat=3)
+            cached = timeit(single_write, repeat=3)
+            db = server.realm_state().db
+            identical = identical and server.bib_to_bibtex(server.realm_state()) == bibtexparser.dumps(db)
+        print("%10d %14.2f %14.2f %9.0fx %10s" % (count, full * 1000, cached * 1000, full / cached, identical))
+
+
+if __name__ == "__main__":
+    main()
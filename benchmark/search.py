@@ -0,0 +1,50 @@
+import random
+
+from common import COMMON, install_realm, make_entries, request_context, server, timeit
+
+QUERIES = 50
+
+
+def linear_search(realm, query):
+    """search_entry() before the trigram index, used as the reference."""
+    query_parts = query.split(" ")
+    entries = []
+    for entry in server.realms[realm].db.entries:
+        found_part = [False for q in query_parts]
+        for field in entry:
+            for (idx, q) in enumerate(query_parts):
+                if field.lower() != "entrytype" and q.lower() in entry[field].lower():
+                    found_part[idx] = True
+        was_found = True
+        for q in found_part:
+            was_found &= q
+        if was_found:
+            entries.append((server.entry_to_bibtex(entry)))
+    return "\n".join(list(set(entries)))
+
+
+def make_queries(rnd, entries):
+    queries = []
+    for _ in range(QUERIES):
+        entry = rnd.choice(entries)
+        words = [w for w in (entry["title"] + " " + entry["author"]).split(" ") if len(w) >= 3 and w.lower() not in COMMON]
+        queries.append(" ".join(rnd.sample(words, min(len(words), rnd.randint(1, 2)))))
+    return queries
+
+
+def main():
+    print("%10s %14s %14s %10s %12s" % ("entries", "linear [ms]", "index [ms]", "speedup", "mismatches"))
+    for count in [1000, 10000, 50000]:
+        realm = "search%d" % count
+        entries = make_entries(count)
+        install_realm(realm, entries)
+        queries = make_queries(random.Random(count), entries)
+        with request_context(realm):
+            mismatches = sum(1 for q in queries if set(linear_search(realm, q).split("\n")) != set(server.search_entry(q, None).split("\n")))
+            linear = timeit(lambda: [linear_search(realm, q) for q in queries], repeat=1)
+            indexed = timeit(lambda: [server.search_entry(q, None) for q in queries], repeat=3)
+        print("%10d %14.2f %14.2f %9.0fx %12d" % (count, linear * 1000 / QUERIES, indexed * 1000 / QUERIES, linear / indexed, mismatches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+import bibtexparser
+
+from common import make_entries, request_context, server, timeit
+
+
+def same_state(a, b):
+    """Whether two states give the same answers, as far as the snapshot is concerned."""
+    if a.db.entries != b.db.entries or a.db.strings != b.db.strings:
+        return False
+    for (x, y) in zip(a.db.entries[::50], b.db.entries[::50]):
+        if [e["ID"] for e in a.dups.candidates(x, a.search) or []] != [e["ID"] for e in b.dups.candidates(y, b.search) or []]:
+            return False
+        query = x.get("title", x["ID"]).split()[:2]
+        if sorted(e["ID"] for e in a.search.candidates(query)) != sorted(e["ID"] for e in b.search.candidates(query)):
+            return False
+    return server.bib_to_bibtex(a) == server.bib_to_bibtex(b)
+
+
+def main():
+    root = tempfile.mkdtemp(prefix="bibtool-startup-")
+    server.repo_path = root
+    server.repo_name = "main.bib"
+    server.cache_path = os.path.join(root, ".cache")
+    print("%10s %14s %14s %10s %10s" % ("entries", "parse [ms]", "snapshot [ms]", "speedup", "identical"))
+    try:
+        for count in [1000, 5000, 10000]:
+            realm = "startup%d" % count
+            os.makedirs(os.path.join(root, realm))
+            db = bibtexparser.bibdatabase.BibDatabase()
+            db.entries = make_entries(count, duplicate_rate=0.01)
+            with open(os.path.join(root, realm, "main.bib"), "w") as f:
+                f.write(bibtexparser.dumps(db))
+            with request_context(realm):
+                parsed = server.read_realm_state(realm)
+                parse = timeit(lambda: server.read_realm_state(realm), repeat=1)
+                server.bib_to_bibtex(parsed)
+                server.schedule_snapshot(realm, parsed, server.snapshots[realm][1])
+                server.write_snapshot(realm)
+                loaded = server.read_realm_state(realm)
+                snapshot = timeit(lambda: server.read_realm_state(realm), repeat=3)
+                identical = same_state(parsed, loaded)
+            print("%10d %14.2f %14.2f %9.0fx %10s" % (count, parse * 1000, snapshot * 1000, parse / snapshot, identical))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import random
+
+import Levenshtein
+
+from common import install_realm, make_entries, make_typo, request_context, server, timeit
+
+KEYS = 40
+
+
+def linear_suggest(realm, key):
+    """suggest_entry() before the suggestion index, used as the reference."""
+    entries = []
+    for entry in server.realms[realm].db.entries:
+        dist = Levenshtein.distance(entry["ID"].lower(), key.lower())
+        if key.lower() in entry["ID"].lower() or dist == 0:
+            entries.append((1, entry))
+            continue
+        if dist < 5:
+            entries.append((1-dist/100.0, entry))
+            continue
+        common_prefix = 0
+        for i in range(min(len(entry["ID"]), len(key))):
+            if entry["ID"].lower()[i] != key.lower()[i]:
+                break
+            common_prefix += 1
+        if common_prefix >= 6:
+            entries.append((common_prefix/float(max(len(entry["ID"]), len(key))), entry))
+    top = sorted(entries, key=lambda x: x[0], reverse=True)
+    return top[:5]
+
+
+def indexed_suggest(realm, key):
+    top = sorted(server.realms[realm].suggest.suggestions(key), key=lambda x: x[0], reverse=True)
+    return top[:5]
+
+
+def make_keys(rnd, entries):
+    keys = []
+    for _ in range(KEYS):
+        key = rnd.choice(entries)["ID"]
+        for _ in range(rnd.randint(1, 3)):
+            key = make_typo(rnd, key)
+        keys.append(key)
+    return keys
+
+
+def main():
+    print("%10s %14s %14s %10s %12s" % ("entries", "linear [ms]", "index [ms]", "speedup", "mismatches"))
+    for count in [1000, 10000, 50000]:
+        realm = "suggest%d" % count
+        entries = make_entries(count)
+        install_realm(realm, entries)
+        keys = make_keys(random.Random(count), entries)
+        with request_context(realm):
+            mismatches = sum(1 for key in keys if linear_suggest(realm, key) != indexed_suggest(realm, key))
+            linear = timeit(lambda: [linear_suggest(realm, key) for key in keys], repeat=1)
+            indexed = timeit(lambda: [indexed_suggest(realm, key) for key in keys], repeat=3)
+        print("%10d %14.2f %14.2f %9.0fx %12d" % (count, linear * 1000 / KEYS, indexed * 1000 / KEYS, linear / indexed, mismatches))
+
+
+if __name__ == "__main__":
+    main()
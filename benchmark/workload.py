@@ -0,0 +1,131 @@
+import argparse
+import gzip
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import (make_entries, make_entry, make_typo, make_variant, percentile, request_context, server,
+                    use_repository, write_realm)
+
+TOKEN = "bench"
+
+
+class Session:
+    """One run of 'client.py get' for a paper, with the requests the client sends."""
+
+    def __init__(self, client, realm, latencies, lock):
+        self.client = client
+        self.realm = realm
+        self.latencies = latencies
+        self.lock = lock
+
+    def call(self, name, method, path, data=None):
+        start = time.perf_counter()
+        response = self.client.open(path, method=method, json=data, headers={"Accept-Encoding": "gzip"})
+        body = response.get_data()
+        if response.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+        return json.loads(body) if response.mimetype == "application/json" else body
+
+    def run(self, keys, local, known):
+        self.call("version", "GET", "/v1/version?token=%s&realm=%s" % (TOKEN, self.realm))
+        data = {"keys": [key for key in keys if key not in local], "token": TOKEN, "realm": self.realm}
+        if len(local) > 0:
+            hashes = [[entry["ID"], server.entry_hash(entry)] for entry in local.values()]
+            changed = self.call("changed", "POST", "/v1/changed", {"hashes": hashes, "token": TOKEN, "realm": self.realm})
+            data["entries"] = [local[key] for key in changed["changed"]]
+        if known:
+            data["known"] = known
+        result = self.call("resolve", "POST", "/v1/resolve", data)
+        if not result["success"]:
+            raise Exception("resolve failed: %s" % result)
+
+
+def make_session(rnd, entries, by_id, cited):
+    """Keys of a paper, its local entries, and the hashes the client remembers from an earlier run."""
+    keys = [rnd.choice(entries)["ID"] for _ in range(cited)]
+    keys += [make_typo(rnd, rnd.choice(entries)["ID"]) for _ in range(2)]
+    kind = rnd.random()
+    local = {}
+    known = {}
+    if kind < 0.4:
+        # first run of the paper
+        pass
+    elif kind < 0.8:
+        # later run, the server's bibliography changed since
+        known = {key: server.entry_hash(by_id[key]) for key in keys if key in by_id and rnd.random() < 0.9}
+    else:
+        # the author edited and added entries in main.bib
+        for entry in rnd.sample(entries, 20):
+            entry = make_variant(rnd, entry, 1) if rnd.random() < 0.2 else dict(entry)
+            local[entry["ID"]] = entry
+        for idx in range(2):
+            entry = make_entry(rnd, 10 ** 8 + rnd.randrange(10 ** 8))
+            local[entry["ID"]] = entry
+            keys.append(entry["ID"])
+    return (keys, local, known)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays 'client.py get' sessions against the server")
+    parser.add_argument("--entries", type=int, default=20000, help="Entries in the realm")
+    parser.add_argument("--sessions", type=int, default=200, help="Number of sessions")
+    parser.add_argument("--threads", type=int, default=4, help="Sessions running at the same time")
+    parser.add_argument("--cited", type=int, default=60, help="Keys cited by each paper")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bibtool-workload-")
+    realm = "workload"
+    use_repository(root)
+    server.no_commit = True
+    try:
+        entries = make_entries(args.entries, seed=args.seed, duplicate_rate=0.02, typo_rate=0.01)
+        write_realm(root, realm, entries, token=TOKEN)
+        rnd = random.Random(args.seed)
+        by_id = {entry["ID"]: entry for entry in entries}
+        sessions = [make_session(rnd, entries, by_id, args.cited) for _ in range(args.sessions)]
+
+        start = time.perf_counter()
+        with request_context(realm):
+            server.ensure_realm_loaded(realm)
+        print("Realm with %d entries loaded in %.2f s" % (args.entries, time.perf_counter() - start))
+
+        latencies = {}
+        lock = threading.Lock()
+        clients = threading.local()
+
+        def run(session):
+            if not hasattr(clients, "client"):
+                clients.client = server.app.test_client()
+            Session(clients.client, realm, latencies, lock).run(*session)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(run, sessions))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.compact_journals()
+        server.flush_snapshots()
+        shutil.rmtree(root)
+
+    print("%10s %8s %12s %12s %12s" % ("request", "count", "mean [ms]", "p50 [ms]", "p99 [ms]"))
+    for name in ["version", "changed", "resolve"]:
+        times = latencies.get(name, [])
+        if len(times) > 0:
+            print("%10s %8d %12.2f %12.2f %12.2f" % (name, len(times), 1000 * sum(times) / len(times),
+                  1000 * percentile(times, 50), 1000 * percentile(times, 99)))
+    requests = sum(len(times) for times in latencies.values())
+    print("%d sessions (%d requests) with %d threads in %.2f s: %.1f sessions/s, %.1f requests/s" %
+          (len(sessions), requests, args.threads, elapsed, len(sessions) / elapsed, requests / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,22 @@ from bibtexparser.bparser import BibTexParser
 import difflib
 import os
 import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
 
-version = 15
+# urllib3 lists zstd once it can decode it (urllib3 2 with zstandard installed)
+accept_encoding = "zstd, gzip" if "zstd" in ACCEPT_ENCODING else "gzip"
+
+version = 23
 
 limit_traffic = True
 
+# number of requests that run at the same time, e.g., for suggestions
+max_workers = 8
+
 parser = argparse.ArgumentParser(description='BibTool')
 parser.add_argument("--token", dest="token", action="store", default="", help="Provide access token via command line")
 parser.add_argument("--tokenfile", dest="token_file", action="store", default="token", help="File containing the access token")
@@ -21,6 +32,8 @@ parser.add_argument("--tex", dest="tex", action="store", default="main.tex", hel
 parser.add_argument("--query", dest="query", action="store", default="", help="Query to search for (if action is search)")
 parser.add_argument("action")
 parser.add_argument("--realm", dest="realm", action="store", required=True, help="Realm to select repository")
+parser.add_argument("--timeout", dest="timeout", action="store", type=float, default=30, help="Timeout for server requests in seconds")
+parser.add_argument("--retries", dest="retries", action="store", type=int, default=3, help="Number of retries for failed server requests")
 
 args = parser.parse_args(sys.argv[1:])
 
@@ -38,6 +51,23 @@ server = args.server
 if server[-1] != '/': server += "/"
 if not server.endswith("/v1/"): server += "v1/"
 
+# one session for all requests, so connections are kept alive and reused
+session = requests.Session()
+session.headers["Accept-Encoding"] = accept_encoding
+# connection errors are always retried, other errors and 502-504 only for requests that can safely be repeated
+retry = Retry(total=args.retries, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET", "PUT", "DELETE"], raise_on_status=False)
+session.mount("http://", HTTPAdapter(pool_maxsize=max_workers, max_retries=retry))
+session.mount("https://", HTTPAdapter(pool_maxsize=max_workers, max_retries=retry))
+pool = ThreadPoolExecutor(max_workers=max_workers)
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", args.timeout)
+    try:
+        return session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        print("\u001b[31m[!] Could not reach the server.\u001b[0m %s" % e)
+        sys.exit(1)
+
 def append_token_realm(url, token=None, realm=None):
     if token:
         url += "/%s" % token
@@ -45,35 +75,108 @@ def append_token_realm(url, token=None, realm=None):
         url += "/%s" % realm
     return url
 
-def get_keys(filename, import_base=None):
+# natbib and biblatex commands whose first mandatory argument are citation keys
+cite_commands = ["cite", "Cite", "citet", "Citet", "citep", "Citep", "citealt", "Citealt", "citealp", "Citealp",
+                 "citeauthor", "Citeauthor", "citefullauthor", "Citefullauthor", "citeyear", "citeyearpar", "citenum",
+                 "citetalias", "citepalias", "defcitealias", "parencite", "Parencite", "footcite", "Footcite", "footcitetext",
+                 "textcite", "Textcite", "smartcite", "Smartcite", "autocite", "Autocite", "supercite", "fullcite",
+                 "footfullcite", "citetitle", "Citetitle", "citedate", "citeurl", "citefield", "citelist", "citename",
+                 "nocite", "citeA", "citeNP"]
+# biblatex multicite commands, e.g. \cites[see][1]{a}[2]{b}, every mandatory argument are citation keys
+multicite_commands = ["cites", "Cites", "parencites", "Parencites", "footcites", "footcitetexts", "textcites", "Textcites",
+                      "smartcites", "Smartcites", "autocites", "Autocites", "supercites"]
+# optional [..] and, for multicites, (..) arguments
+cite_options = r"(?:\s*(?:\[[^\]]*\]|\([^\)]*\)))*"
+cite_regex = re.compile(r"\\(?:%s)\*?(?![a-zA-Z])%s\s*\{([^\}]*)\}" % ("|".join(cite_commands), cite_options))
+multicite_regex = re.compile(r"\\(?:%s)\*?(?![a-zA-Z])((?:%s\s*\{[^\}]*\})+)" % ("|".join(multicite_commands), cite_options))
+cite_argument_regex = re.compile(r"\{([^\}]*)\}")
+input_regex = re.compile(r"\\(?:input|include)\{([^\}]+)\}")
+subimport_regex = re.compile(r"\\subimport\*?\{([^\}]*)\}\{([^\}]*)\}")
+
+
+def scan_tex(content):
+    keys = set()
+    for argument in cite_regex.findall(content):
+        keys |= set(argument.split(","))
+    for arguments in multicite_regex.findall(content):
+        for argument in cite_argument_regex.findall(arguments):
+            keys |= set(argument.split(","))
+    return {
+        "keys": sorted(k.strip() for k in keys if k.strip() not in ("", "*")),
+        "inputs": input_regex.findall(content),
+        "subimports": [list(s) for s in subimport_regex.findall(content)]
+    }
+
+
+def load_scan_cache():
     try:
-        if not os.path.isfile(filename):
-            filename += ".tex"
-        content = open(filename).read()
+        return json.load(open("main.bib.scan"))
     except:
-        return []
+        return {}
+
+
+def save_scan_cache(cache):
+    try:
+        with open("main.bib.scan", "w") as cache_file:
+            json.dump(cache, cache_file)
+    except:
+        pass
+
 
-    # extract cites
+def scan_file(filename, cache):
+    try:
+        stat = os.stat(filename)
+    except:
+        return None
+    cached = cache.get(filename)
+    if cached and cached["mtime"] == stat.st_mtime and cached["size"] == stat.st_size:
+        return cached
+    try:
+        content = open(filename, "rb").read()
+    except:
+        return None
+    digest = hashlib.sha256(content).hexdigest()
+    if not cached or cached["hash"] != digest:
+        cached = scan_tex(content.decode("utf-8", errors="replace"))
+        cached["hash"] = digest
+    cached["mtime"] = stat.st_mtime
+    cached["size"] = stat.st_size
+    cache[filename] = cached
+    cache["_changed"] = True
+    return cached
+
+
+def get_keys(filename):
+    cache = load_scan_cache()
     keys = set()
-    cites = re.findall("\\\\(no)?citeA?\\{([^\\}]+)\\}", content)
-    for key in cites:
-        keys |= set(key[1].split(","))
-    # find inputs/include and recursively parse them
-    inputs = re.findall("\\\\(?:input|include)\\{([^\\}]+)\\}", content)
-    for f in inputs:
-        if import_base is not None:
-            f = os.path.join(import_base, f)
-        keys |= set(get_keys(f))
-
-    # find subimports and recursively parse them
-    subimports = re.findall("\\\\subimport\*?\\{(.*)\\}\\{(.*)\\}", content)
-    for f in subimports:
-        filepath = os.path.join(f[0], f[1])
-        keys |= set(get_keys(filepath, import_base=f[0]))
-
-    keys = sorted(list([k.strip() for k in keys]))
-    keys = [k for k in keys if len(k) != 0]
-    return keys
+    visited = set()
+    todo = [(filename, None)]
+    while todo:
+        filename, import_base = todo.pop()
+        if not os.path.isfile(filename):
+            filename += ".tex"
+        # a file can be reached several times, and includes can form cycles
+        path = (os.path.realpath(filename), import_base)
+        if path in visited:
+            continue
+        visited.add(path)
+        scanned = scan_file(filename, cache)
+        if scanned is None:
+            continue
+        keys |= set(scanned["keys"])
+        # find inputs/include and subimports and parse them as well
+        for f in scanned["inputs"]:
+            if import_base is not None:
+                f = os.path.join(import_base, f)
+            todo.append((f, None))
+        for f in scanned["subimports"]:
+            todo.append((os.path.join(f[0], f[1]), f[0]))
+
+    if cache.pop("_changed", False):
+        # forget files that are no longer part of the document
+        used = set(path for (path, _) in visited)
+        save_scan_cache({f: c for (f, c) in cache.items() if os.path.realpath(f) in used})
+    return sorted(keys)
 
 
 def keys_have_changed(keys):
@@ -102,10 +205,7 @@ def bib_has_changed(bib):
 
 
 def entry_by_key(key):
-    for entry in bib_database.entries:
-        if entry["ID"] == key:
-            return entry
-    return None
+    return local_entries.get(key)
 
 
 def entry_to_bibtex(entry):
@@ -173,38 +273,43 @@ def resolve_policy_reject():
 
 
 def update_local_bib(key, new_entry):
-    for (idx, entry) in enumerate(bib_database.entries):
-        if entry["ID"] == key:
-            bib_database.entries[idx] = new_entry
-            break
-
-
-def update_remote_bib(key, new_entry):
-    response = requests.put(server + "entry/%s" % key, json = {"entry": new_entry, "token": token, "realm": args.realm})
+    global bib_changed
+    old_entry = local_entries.get(key)
+    if old_entry is not None:
+        idx = next(i for (i, entry) in enumerate(bib_database.entries) if entry is old_entry)
+        bib_database.entries[idx] = new_entry
+        local_entries[key] = new_entry
+        bib_changed = True
+
+
+def remote_change(method, url, **kwargs):
+    # not run on the pool, the server checks its policies against the changes made before,
+    # and an error stops the client before the next conflict is shown
+    response = request(method, url, **kwargs)
     if "success" in response.json() and not response.json()["success"]:
         show_error(response.json())
 
+def update_remote_bib(key, new_entry):
+    remote_change("PUT", server + "entry/%s" % key, json = {"entry": new_entry, "token": token, "realm": args.realm})
+
 def add_remote_bib(key, entry, force=False):
     data = {"entry": entry, "token": token, "realm": args.realm}
     if force:
         data["force"] = "true"
-    response = requests.post(server + "entry/%s" % key, json = data)
-    if "success" in response.json() and not response.json()["success"]:
-        show_error(response.json())
+    remote_change("POST", server + "entry/%s" % key, json = data)
 
 def remove_remote_bib(key):
     url = server + "entry/%s" % key
     url = append_token_realm(url, token, args.realm)
-    response = requests.delete(url)
-    if "success" in response.json() and not response.json()["success"]:
-        show_error(response.json())
+    remote_change("DELETE", url)
 
 
 def remove_local_bib(key):
-    for (idx, entry) in enumerate(bib_database.entries):
-        if entry["ID"] == key:
-            del bib_database.entries[idx]
-            save_bib()
+    global bib_changed
+    if key in local_entries:
+        bib_database.entries = [entry for entry in bib_database.entries if entry["ID"] != key]
+        del local_entries[key]
+        bib_changed = True
 
 
 def save_bib_hash():
@@ -221,6 +326,12 @@ def save_bib():
     save_bib_hash()
 
 
+def save_bib_if_changed():
+    # main.bib is written once when the client exits, also if it stops early
+    if bib_changed:
+        save_bib()
+
+
 def show_error(obj):
     if "reason" in obj:
         if obj["reason"] == "access_denied":
@@ -234,6 +345,106 @@ def show_error(obj):
         print("\u001b[31m[!] Unknown error occurred!\u001b[0m")
     sys.exit(1)
 
+def resolve_rejects(entries):
+    for entry in entries:
+        print("\n[!] Server policy rejected entry %s. Reason: %s" % (entry["ID"], entry["reason"]))
+        action = resolve_policy_reject()
+        if action == "i":
+            pass
+        elif action == "a":
+            sys.exit(1)
+        elif action == "f":
+            add_remote_bib(entry["ID"], entry_by_key(entry["ID"]), force=True)
+
+
+def resolve_duplicates(dups):
+    for dup in dups:
+        print("\n[!] There is already a similar entry for %s on the server (%s) [Levenshtein %d]" % (dup[1], dup[2]["ID"], dup[0]))
+        print("- Local -")
+        local = entry_to_bibtex(entry_by_key(dup[1]))
+        remote = entry_to_bibtex(dup[2])
+        print(local)
+        print("- Server -")
+        print(remote)
+        print("- Diff - ")
+        print(inline_diff(remote, local))
+
+        if dup[1] != dup[2]["ID"]:
+            # different key, similar entry
+            action = resolve_duplicate()
+            if action == "i":
+                pass
+            elif action == "a":
+                sys.exit(1)
+            elif action == "d":
+                remove_remote_bib(dup[2]["ID"])
+                removed_remote.add(dup[2]["ID"])
+            elif action == "m":
+                add_remote_bib(dup[1], entry_by_key(dup[1]))
+            elif action == "r":
+                remove_local_bib(dup[1])
+        else:
+            # same key
+            action = resolve_changes()
+            if action == "a":
+                sys.exit(1)
+            elif action == "i":
+                pass
+            elif action == "s":
+                update_local_bib(dup[1], dup[2])
+            elif action == "l":
+                update_remote_bib(dup[2]["ID"], entry_by_key(dup[1]))
+
+
+def merge_entries(bib):
+    # merge local and remote database
+    global bib_changed
+    for entry in bib:
+        if entry and "ID" in entry and not entry["ID"] in local_entries and not entry["ID"] in removed_remote:
+            bib_database.entries.append(entry)
+            local_entries[entry["ID"]] = entry
+            bib_changed = True
+
+
+def show_suggestions(key, entries):
+    print("Key '%s' not found%s %s" % (key, ", did you mean any of these?" if len(entries) > 0 else "", ", ".join(["'%s'" % e[1]["ID"] for e in entries])))
+
+
+def entry_hash(entry):
+    return hashlib.sha1(json.dumps(entry, sort_keys = True).encode("utf-8")).hexdigest()[:16]
+
+def changed_entries(entries):
+    # only upload the entries that differ from the server's copy
+    if "changed" not in version_info.get("features", []):
+        return entries
+    hashes = [[entry["ID"], entry_hash(entry)] for entry in entries]
+    response = request("POST", server + "changed", json = {"hashes": hashes, "token": token, "realm": args.realm})
+    result = response.json()
+    if not result["success"]:
+        return entries
+    changed = set(result["changed"])
+    return [entry for entry in entries if entry["ID"] in changed]
+
+def load_entry_cache():
+    # server answers for cited keys (null if not on the server) at the given realm revision
+    try:
+        cache = json.load(open("main.bib.cache"))
+        if cache["realm"] == args.realm:
+            return cache
+    except:
+        pass
+    return {"realm": args.realm, "revision": None, "entries": {}}
+
+def save_entry_cache(cache):
+    try:
+        with open("main.bib.cache", "w") as cache_file:
+            json.dump(cache, cache_file)
+    except:
+        pass
+
+# server entries deleted while resolving duplicates, must not be merged back
+removed_remote = set()
+
 action = args.action
 
 parser = BibTexParser(common_strings=True)
@@ -252,7 +463,15 @@ else:
         print(e)
         sys.exit(1)
 
-response = requests.get(server + "version")
+# local entries by key, the first one wins if a key is used twice
+local_entries = {}
+for entry in bib_database.entries:
+    local_entries.setdefault(entry["ID"], entry)
+bib_changed = False
+atexit.register(save_bib_if_changed)
+
+# with the token, the server also tells the revision of the realm
+response = request("GET", server + "version", params={"token": token, "realm": args.realm})
 try:
     version_info = response.json()
 except:
@@ -261,7 +480,7 @@ except:
 
 if version_info["version"] > version:
     print("[!] New version available, updating...")
-    script = requests.get(server + version_info["url"])
+    script = request("GET", server + version_info["url"])
     with open(sys.argv[0], "w") as sc:
         sc.write(script.text)
     print("Restarting...")
@@ -274,13 +493,13 @@ if action == "search":
         sys.exit(1)
     url = server + "search/" + args.query
     url = append_token_realm(url, token, args.realm)
-    response = requests.get(url)
+    response = request("GET", url)
     print(response.text)
 
 elif action == "sync":
     url = server + "sync"
     url = append_token_realm(url, token, args.realm)
-    response = requests.get(url)
+    response = request("GET", url)
     print(response.text)
 
 elif action == "get":
@@ -292,6 +511,7 @@ elif action == "get":
     except:
         update = False
         fetch = True
+        bib_changed = True
 
     if update:
         fetch = True
@@ -300,85 +520,84 @@ elif action == "get":
         fetch = True
     #print("fetch %d, update %d\n" % (fetch, update))
 
-    # update
-    if update:
-        response = requests.post(server + "update", json = {"entries": bib_database.entries, "token": token, "realm": args.realm})
-        result = response.json()
-        if not result["success"]:
-            if result["reason"] == "policy":
-                #print(result["entries"])
-                for entry in result["entries"]:
-                    print("\n[!] Server policy rejected entry %s. Reason: %s" % (entry["ID"], entry["reason"]))
-                    action = resolve_policy_reject()
-                    if action == "i":
-                        pass
-                    elif action == "a":
-                        sys.exit(1)
-                    elif action == "f":
-                        add_remote_bib(entry["ID"], entry_by_key(entry["ID"]), force=True)
-            elif result["reason"] == "duplicate":
-                #print(result["entries"])
-                for dup in result["entries"]:
-                    print("\n[!] There is already a similar entry for %s on the server (%s) [Levenshtein %d]" % (dup[1], dup[2]["ID"], dup[0]))
-                    print("- Local -")
-                    local = entry_to_bibtex(entry_by_key(dup[1]))
-                    remote = entry_to_bibtex(dup[2])
-                    print(local)
-                    print("- Server -")
-                    print(remote)
-                    print("- Diff - ")
-                    print(inline_diff(remote, local))
-
-                    if dup[1] != dup[2]["ID"]:
-                        # different key, similar entry
-                        action = resolve_duplicate()
-                        if action == "i":
-                            pass
-                        elif action == "a":
-                            sys.exit(1)
-                        elif action == "d":
-                            remove_remote_bib(dup[2]["ID"])
-                        elif action == "m":
-                            add_remote_bib(dup[1], entry_by_key(dup[1]))
-                        elif action == "r":
-                            remove_local_bib(dup[1])
-                    else:
-                        # same key
-                        action = resolve_changes()
-                        if action == "a":
-                            sys.exit(1)
-                        elif action == "i":
-                            pass
-                        elif action == "s":
-                            update_local_bib(dup[1], dup[2])
-                            save_bib()
-                        elif action == "l":
-                            update_remote_bib(dup[2]["ID"], entry_by_key(dup[1]))
-            else:
+    if "resolve" in version_info.get("features", []):
+        request_keys = keys
+        cache = None
+        if "revision" in version_info.get("features", []) and limit_traffic:
+            # only ask for cited keys that are neither in main.bib nor answered at the current revision
+            cache = load_entry_cache()
+            current = cache["revision"] is not None and cache["revision"] == version_info.get("revision")
+            request_keys = []
+            cached = []
+            for key in keys:
+                if entry_by_key(key):
+                    continue
+                if current and key in cache["entries"] and (cache["entries"][key] or not fetch):
+                    cached.append(cache["entries"][key])
+                else:
+                    request_keys.append(key)
+            if any(cached):
+                merge_entries(cached)
+            fetch = len(request_keys) > 0
+
+        if update or fetch:
+            data = {"keys": request_keys, "token": token, "realm": args.realm}
+            if update:
+                data["entries"] = changed_entries(bib_database.entries)
+            if cache:
+                data["known"] = {key: entry_hash(cache["entries"][key]) for key in request_keys if cache["entries"].get(key)}
+            response = request("POST", server + "resolve", json = data)
+            result = response.json()
+            if not result["success"]:
                 show_error(result)
+            entries = result["entries"]
+            if cache:
+                # true means the cached entry is still current
+                entries = [cache["entries"][key] if entry is True else entry for (key, entry) in zip(request_keys, entries)]
+                cache["entries"] = dict(zip(request_keys, entries))
+                cache["revision"] = result.get("revision")
+                save_entry_cache(cache)
+            resolve_rejects(result["rejects"])
+            resolve_duplicates(result["duplicates"])
+            merge_entries(entries)
+            if "suggest_error" in result:
+                show_error(result["suggest_error"])
+            for key in request_keys:
+                if not entry_by_key(key) and not '#' in key:
+                    show_suggestions(key, result["suggestions"].get(key, []))
 
-    if fetch:
-        response = requests.post(server + "get_json", json = {"entries": keys, "token": token, "realm": args.realm})
-        bib = response.json()
-        if "success" in bib and not bib["success"]:
-            show_error(bib)
-        else:
-            # merge local and remote database
-            for entry in bib:
-                if entry and "ID" in entry and not entry_by_key(entry["ID"]):
-                    bib_database.entries.append(entry)
-            save_bib()
+    else:
+        # update
+        upload = changed_entries(bib_database.entries) if update else []
+        if len(upload) > 0:
+            response = request("POST", server + "update", json = {"entries": upload, "token": token, "realm": args.realm})
+            result = response.json()
+            if not result["success"]:
+                if result["reason"] == "policy":
+                    resolve_rejects(result["entries"])
+                elif result["reason"] == "duplicate":
+                    resolve_duplicates(result["entries"])
+                else:
+                    show_error(result)
+
+        if fetch:
+            response = request("POST", server + "get_json", json = {"entries": keys, "token": token, "realm": args.realm})
+            bib = response.json()
+            if "success" in bib and not bib["success"]:
+                show_error(bib)
+            else:
+                merge_entries(bib)
 
-            # suggest keys for unresolved keys
-            for key in keys:
-                if not entry_by_key(key) and not '#' in key:
-                    url = server + "suggest/" + key + "/%s/%s" % (token, args.realm)
-                    response = requests.get(url)
+                # suggest keys for unresolved keys, ask for all of them at once but show them in order
+                missing = [key for key in keys if not entry_by_key(key) and not '#' in key]
+                urls = [server + "suggest/" + key + "/%s/%s" % (token, args.realm) for key in missing]
+                responses = pool.map(lambda url: request("GET", url), urls)
+                for (key, response) in zip(missing, responses):
                     suggest = response.json()
                     if "success" in suggest and not suggest["success"]:
                         show_error(suggest)
                     else:
-                        print("Key '%s' not found%s %s" % (key, ", did you mean any of these?" if len(suggest["entries"]) > 0 else "", ", ".join(["'%s'" % e[1]["ID"] for e in suggest["entries"]])))
+                        show_suggestions(key, suggest["entries"])
 
 else:
     print("Unknown action '%s'" % action)
@@ -1,28 +1,106 @@
 import bibtexparser
+import collections
 from bibtexparser.bparser import BibTexParser
-from flask import Flask, jsonify, request
+from bibtexparser.bwriter import BibTexWriter
+from flask import Flask, g, has_app_context, jsonify, request, stream_with_context
 import Levenshtein
 import git
+import atexit
+import cProfile
+import contextlib
+import bisect
+import hashlib
+import hmac
+import io
 import json
+import marshal
+import math
+import multiprocessing
+import os
+import pstats
+import re
 import sys
+import tempfile
+import threading
+import time
 import importlib
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-VERSION = 15
+VERSION = 23
 
 app = Flask(__name__)
 tokens = True
 no_commit = False
+commit_window = float(os.environ.get("BIBTOOL_COMMIT_WINDOW", "2"))  # seconds to collect writes into one commit
+push_backoff_max = 300
+reload_window = float(os.environ.get("BIBTOOL_RELOAD_WINDOW", "5"))  # seconds to collect webhooks into one reload
+snapshot_delay = 10  # seconds to wait for more writes before a realm snapshot is written
+cache_path = os.environ.get("BIBTOOL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "bibtool"))  # realm snapshots, outside the repositories
+compact_delay = float(os.environ.get("BIBTOOL_COMPACT_DELAY", "5"))  # seconds after a write until the journal is folded into the bib file
+compact_size = 4 * 1024 * 1024  # bytes of journal from which it is folded right away
+import_batch = 1000  # entries of a bulk import that are added at once
+SNAPSHOT_VERSION = 1
+max_realms = int(os.environ.get("BIBTOOL_MAX_REALMS", "0"))  # realms kept in memory, 0 for no limit
+max_memory = int(os.environ.get("BIBTOOL_MAX_MEMORY", "0")) * 1024 * 1024  # MB for all realms, 0 for no limit
+duplicate_workers = int(os.environ.get("BIBTOOL_DUPLICATE_WORKERS", "1"))  # processes for large uploads, 1 scores them in the server
+parallel_duplicates = 20000  # candidate pairs of narrowed entries from which an upload is scored in several processes
+duplicate_pool = None
+duplicate_pool_lock = threading.Lock()
+policy_budget = float(os.environ.get("BIBTOOL_POLICY_BUDGET", "5"))  # seconds all policies may take per request
+policies = []  # policy modules, applied in order
+policy_stats = {}  # policy name -> counters
+policy_workers = int(os.environ.get("BIBTOOL_POLICY_WORKERS", "2"))  # threads of each policy
+policy_pools = {}  # policy name -> ThreadPoolExecutor with policy_workers threads
+policy_stats_lock = threading.Lock()
+metric_counters = {}  # metric name -> {labels: value}
+metric_histograms = {}  # metric name -> {labels: [count per bucket, sum, count]}
+metrics_lock = threading.Lock()
+HISTOGRAM_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+monitor_token = os.environ.get("BIBTOOL_MONITOR_TOKEN")  # bearer token that shows all realms at /v1/status and /v1/metrics
+profile_retention = int(os.environ.get("BIBTOOL_PROFILE_RETENTION", "50"))  # profiles kept in memory
+profiles = collections.OrderedDict()  # profile id -> profile, oldest first
+profile_sampling = {}  # (realm, endpoint) -> (profiled requests, out of this many requests)
+profile_requests = {}  # (realm, endpoint) -> number of requests, to pick the sampled ones
+profile_all_threads = sys.version_info >= (3, 12)  # cProfile is process-wide, one request is profiled at a time
+profile_lock = threading.Lock()
 
 # Per-realm global state
 token_db = {}
-bib_database = {}
+realms = {}  # realm -> RealmState, replaced as a whole on every change
+realm_locks = {}  # realm -> lock held by writers
+realm_locks_lock = threading.Lock()
 repo = {}
+pipelines = {}  # realm -> WritePipeline
+pipelines_lock = threading.Lock()
+snapshots = {}  # realm -> (RealmState, hash of main.bib), waiting to be written
+snapshots_lock = threading.Lock()
+journals = {}  # realm -> commit messages of the writes in its journal, not yet in the bib file
+folded = {}  # realm -> commit messages of the writes in the bib file, not committed yet
+journals_lock = threading.Lock()
+realm_usage = collections.OrderedDict()  # realm -> time of the last access, least recently used first
+realm_users = {}  # realm -> number of requests using the realm, these are not evicted
+realm_sizes = {}  # realm -> estimated memory in bytes of the published state
+realm_counters = {"hits": 0, "misses": 0, "evictions": 0}
+realm_usage_lock = threading.Lock()
+eviction_requests = []  # realms whose requests found the budget exceeded, these are not evicted
+eviction_cond = threading.Condition()
+eviction_thread = None
+reloads = {}  # realm -> number of webhooks waiting for the next reload
+reloads_lock = threading.Lock()
+imports = {}  # realm -> progress of the running bulk import
+imports_lock = threading.Lock()
 tokens_dict = {}  # for future use if needed
 default_realm = ""
+duplicate_pieces = 3  # pieces of an uploaded entry beyond its edit budget that a duplicate candidate must contain
 
 def get_realm():
     global default_realm
-    if request.method in ["POST", "PUT"]:
+    if request.method in ["POST", "PUT"] and request.is_json:
         if request.json and "realm" in request.json:
             return request.json["realm"]
     if "realm" in request.args:
@@ -48,59 +126,1488 @@ def check_token(token, operation):
     else:
         return (True, None)
 
+def increment(name, value=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        values = metric_counters.setdefault(name, {})
+        values[key] = values.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = tuple(sorted(labels.items()))
+    bucket = bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)
+    with metrics_lock:
+        values = metric_histograms.setdefault(name, {})
+        if key not in values:
+            values[key] = [0] * (len(HISTOGRAM_BUCKETS) + 1) + [0.0, 0]
+        values[key][bucket] += 1
+        values[key][-2] += seconds
+        values[key][-1] += 1
+
+
+@contextlib.contextmanager
+def timed(phase, realm=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("bibtool_phase_seconds", time.perf_counter() - start, phase=phase, realm=get_realm() if realm is None else realm)
+
+
 def entry_to_bibtex(entry):
     newdb = bibtexparser.bibdatabase.BibDatabase()
     newdb.entries = [ entry ]
     return bibtexparser.dumps(newdb)
 
 
-def get_duplicates(entry):
+def entry_hash(entry):
+    """Hash of the entry's content, the client computes the same for its entries."""
+    return hashlib.sha1(json.dumps(entry, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def entry_content(entry):
+    return tuple(sorted(entry.items()))
+
+
+class SharedIndex:
+    """Base class of the indexes of a RealmState, copy() shares nested containers until owned() copies them."""
+
+    tables = []
+    shared = False  # whether nested containers may be shared with another index
+
+    def copy(self):
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        for table in self.tables:
+            setattr(clone, table, getattr(self, table).copy())
+        clone.owned_keys = set()
+        clone.shared = True
+        return clone
+
+    def owned(self, table, key, factory):
+        values = getattr(self, table)
+        if not self.shared:
+            if key not in values:
+                values[key] = factory()
+            return values[key]
+        if key not in values:
+            values[key] = factory()
+            self.owned_keys.add((table, key))
+        elif (table, key) not in self.owned_keys:
+            values[key] = factory(values[key])
+            self.owned_keys.add((table, key))
+        return values[key]
+
+    def freeze(self):
+        self.owned_keys = set()
+
+
+class RenderCache(SharedIndex):
+    """entry_to_bibtex() output by entry, still filled by readers once the state is published."""
+
+    tables = ["rendered"]
+
+    def __init__(self, entries=(), previous=None, rendered=None):
+        self.rendered = {}  # id(entry) -> (entry, bibtex)
+        self.owned_keys = set()
+        if rendered is not None:
+            for (entry, bibtex) in zip(entries, rendered):
+                if bibtex is not None:
+                    self.rendered[id(entry)] = (entry, bibtex)
+            return
+        if previous is None:
+            return
+        by_content = {}
+        # readers still fill the previous cache
+        for (entry, bibtex) in list(previous.rendered.values()):
+            try:
+                by_content[entry_content(entry)] = bibtex
+            except TypeError:
+                pass
+        for entry in entries:
+            try:
+                bibtex = by_content.get(entry_content(entry))
+            except TypeError:
+                continue
+            if bibtex is not None:
+                self.rendered[id(entry)] = (entry, bibtex)
+
+    def get(self, entry):
+        cached = self.rendered.get(id(entry))
+        if cached and cached[0] is entry:
+            return cached[1]
+        bibtex = entry_to_bibtex(entry)
+        if entry is not None:
+            self.rendered[id(entry)] = (entry, bibtex)
+        return bibtex
+
+    def remove(self, entry):
+        self.rendered.pop(id(entry), None)
+
+    def export(self, entries):
+        rendered = []
+        for entry in entries:
+            cached = self.rendered.get(id(entry))
+            rendered.append(cached[1] if cached and cached[0] is entry else None)
+        return rendered
+
+
+def render_entry(entry):
+    return realm_state().render.get(entry)
+
+
+def bib_to_bibtex(state):
+    return "".join(bibtex_chunks(state))
+
+
+def bibtex_chunks(state):
+    writer = BibTexWriter()
+    writer.contents = ["comments", "preambles", "strings"]
+    yield bibtexparser.dumps(state.db, writer)
+    for (idx, entry) in enumerate(file_order(state)):
+        yield ("\n" if idx > 0 else "") + state.render.get(entry)
+
+
+def file_order(state):
+    return sorted(state.db.entries, key=lambda x: str(x.get("ID", "")).lower())
+
+
+def normalize_doi(doi):
+    doi = doi.strip().lower()
+    for prefix in ["https://doi.org/", "http://doi.org/", "https://dx.doi.org/", "http://dx.doi.org/", "doi:"]:
+        if doi.startswith(prefix):
+            doi = doi[len(prefix):]
+    return doi
+
+
+def field_tokens(value):
+    return set(re.findall("[a-z0-9]+", value.lower()))
+
+
+class DuplicateIndex(SharedIndex):
+    tables = ["blocks", "tokens", "order"]
+
+    def __init__(self, entries=(), tokens=None):
+        self.blocks = {}  # block key -> {id(entry): entry}
+        self.tokens = {}  # id(entry) -> {field: tokens}
+        self.order = {}  # id(entry) -> position, to report candidates in file order
+        self.next_order = 0
+        self.owned_keys = set()
+        for (idx, entry) in enumerate(entries):
+            self.add(entry, tokens=tokens[idx] if tokens else None)
+
+    def block_keys(self, entry, tokens):
+        keys = [("id", entry["ID"])]
+        if entry.get("doi"):
+            keys.append(("doi", normalize_doi(entry["doi"])))
+        if len(tokens["title"]) > 0:
+            keys.append(("title", " ".join(sorted(tokens["title"]))))
+        for field in ["title", "author"]:
+            if len(tokens[field]) == 0:
+                keys.append((field + "_missing", ))
+        return keys
+
+    def add(self, entry, order=None, tokens=None):
+        if order is None:
+            order = self.next_order
+            self.next_order += 1
+        self.order[id(entry)] = order
+        if tokens is None:
+            tokens = {field: field_tokens(entry.get(field, "")) for field in ["title", "author"]}
+        self.tokens[id(entry)] = tokens
+        for key in self.block_keys(entry, tokens):
+            self.owned("blocks", key, dict)[id(entry)] = entry
+
+    def remove(self, entry):
+        for key in self.block_keys(entry, self.tokens.pop(id(entry))):
+            if key not in self.blocks:
+                continue
+            block = self.owned("blocks", key, dict)
+            block.pop(id(entry), None)
+            if len(block) == 0:
+                del self.blocks[key]
+        return self.order.pop(id(entry), None)
+
+    def replace(self, old, new):
+        self.add(new, self.remove(old))
+
+    def export(self, entries):
+        return [self.tokens[id(entry)] for entry in entries]
+
+    def candidates(self, entry, search):
+        """The candidate entries in file order, found through search, or None if every entry is one."""
+        found = dict(self.blocks.get(("id", entry["ID"]), {}))
+        fields = ["ID"]
+        for field in ["title", "author"]:
+            if field in entry:
+                fields.append(field)
+                found.update(self.blocks.get((field + "_missing", ), {}))
+        # a duplicate is less than max(5, L/9) edits away, so splitting the uploaded ID, title and
+        # author into that many pieces plus duplicate_pieces, it contains duplicate_pieces of them unchanged
+        edits = int(max(5, sum(len(value) for value in entry.values()) / 9.0))
+        if any(len(entry[field].lower()) != len(entry[field]) for field in fields):
+            edits *= 2  # a character that becomes two when lowercased may be in two pieces
+        # every piece is grown around one of the rarest trigrams that do not overlap
+        texts = {field: entry[field].lower() for field in fields}
+        windows = []
+        for field in fields:
+            for start in range(len(texts[field]) - 2):
+                gram = texts[field][start:start + 3]
+                windows.append((len(search.postings.get(gram, ())) + len(search.recent.get(gram, ())), field, start))
+        windows.sort()
+        starts = {field: [] for field in fields}
+        taken = set()
+        for (_, field, start) in windows:
+            if len(taken) == edits + duplicate_pieces:
+                break
+            if any((field, other) in taken for other in range(start - 2, start + 3)):
+                continue
+            taken.add((field, start))
+            starts[field].append(start)
+        if len(taken) <= edits:
+            return None
+        counts = collections.Counter()
+        for field in fields:
+            text = texts[field]
+            bounds = sorted(starts[field])
+            for (idx, start) in enumerate(bounds):
+                # up to the middle of the gaps to the neighboring pieces
+                left = 0 if idx == 0 else (bounds[idx - 1] + 3 + start) // 2
+                right = len(text) if idx == len(bounds) - 1 else (start + 3 + bounds[idx + 1]) // 2
+                grams = trigrams(text[left:right])
+                counts.update(search.matching(search.postings, grams) | search.matching(search.recent, grams))
+        survivors = len(taken) - edits
+        keys = set(key for (key, count) in counts.items() if count >= survivors)
+        # removed entries stay in the postings for a while
+        keys = (keys & self.order.keys()).union(found)
+        return [found[key] if key in found else search.entries[key] for key in sorted(keys, key=self.order.__getitem__)]
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class SearchIndex(SharedIndex):
+    tables = ["recent", "entries"]
+
+    def __init__(self, entries=(), postings=None):
+        self.postings = {}  # trigram -> set of id(entry), never modified once shared
+        self.recent = {}  # trigram -> set of id(entry), for entries added since the last merge
+        self.recent_count = 0
+        self.stale_count = 0
+        self.entries = {}  # id(entry) -> entry
+        self.owned_keys = set()
+        if postings is not None:
+            keys = [id(entry) for entry in entries]
+            self.entries = dict(zip(keys, entries))
+            self.postings = {gram: set(keys[idx] for idx in posting) for (gram, posting) in postings.items()}
+            return
+        for entry in entries:
+            self.entries[id(entry)] = entry
+            for gram in self.entry_trigrams(entry):
+                self.postings.setdefault(gram, set()).add(id(entry))
+
+    def entry_trigrams(self, entry):
+        grams = set()
+        for field in entry:
+            if field.lower() != "entrytype":
+                grams |= trigrams(entry[field].lower())
+        return grams
+
+    def add(self, entry):
+        self.entries[id(entry)] = entry
+        for gram in self.entry_trigrams(entry):
+            self.owned("recent", gram, set).add(id(entry))
+        self.recent_count += 1
+
+    def remove(self, entry):
+        self.entries.pop(id(entry), None)
+        self.stale_count += 1
+
+    def replace(self, old, new):
+        self.remove(old)
+        self.add(new)
+
+    def rebuild(self):
+        fresh = SearchIndex(self.entries.values())
+        self.postings = fresh.postings
+        self.recent = {}
+        self.recent_count = 0
+        self.stale_count = 0
+        self.owned_keys = set()
+
+    def merge(self):
+        """Moves the recent postings into the merged ones, removed entries stay until rebuild()."""
+        postings = dict(self.postings)
+        for (gram, keys) in self.recent.items():
+            postings[gram] = postings[gram] | keys if gram in postings else set(keys)
+        self.postings = postings
+        self.recent = {}
+        self.recent_count = 0
+        self.owned_keys = set()
+
+    def freeze(self):
+        # merged when the state is published, so a write of many entries merges only once
+        threshold = max(100, len(self.entries) // 50)
+        if self.stale_count > threshold:
+            self.rebuild()
+        elif self.recent_count > threshold:
+            self.merge()
+        SharedIndex.freeze(self)
+
+    def export(self, entries):
+        positions = {id(entry): idx for (idx, entry) in enumerate(entries)}
+        postings = {}
+        for table in [self.postings, self.recent]:
+            for (gram, posting) in table.items():
+                found = [positions[key] for key in posting if key in positions and self.entries.get(key) is entries[positions[key]]]
+                if len(found) > 0:
+                    postings.setdefault(gram, []).extend(found)
+        return postings
+
+    def matching(self, postings, grams):
+        found = None
+        for posting in sorted((postings.get(gram, set()) for gram in grams), key=len):
+            found = set(posting) if found is None else found & posting
+            if len(found) == 0:
+                break
+        return found
+
+    def candidates(self, query_parts):
+        grams = set()
+        for q in query_parts:
+            grams |= trigrams(q.lower())
+        if len(grams) == 0:
+            return list(self.entries.values())
+        # every entry is either in the merged or in the recent postings
+        found = self.matching(self.postings, grams) | self.matching(self.recent, grams)
+        return [self.entries[key] for key in found if key in self.entries]
+
+
+def suggest_score(entry_id, key):
+    entry_id_lower = entry_id.lower()
+    key_lower = key.lower()
+    dist = Levenshtein.distance(entry_id_lower, key_lower)
+    if key_lower in entry_id_lower or dist == 0:
+        return 1
+    if dist < 5:
+        return 1 - dist / 100.0
+    common_prefix = 0
+    for i in range(min(len(entry_id), len(key))):
+        if entry_id_lower[i] != key_lower[i]:
+            break
+        common_prefix += 1
+    if common_prefix >= 6:
+        return common_prefix / float(max(len(entry_id), len(key)))
+    return None
+
+
+class SuggestIndex(SharedIndex):
+    tables = ["keys", "order", "sorted_keys", "grams", "tree_keys"]
+
+    def __init__(self, entries=()):
+        self.keys = {}  # lowercased ID -> {id(entry): entry}
+        self.order = {}  # id(entry) -> position, to keep ties in file order
+        self.next_order = 0
+        self.sorted_keys = []
+        self.grams = {}  # trigram -> set of lowercased IDs
+        self.tree = None  # BK-tree node: [lowercased ID, {distance: child}]
+        self.tree_keys = set()
+        self.owned_keys = set()
+        for entry in entries:
+            self.add(entry)
+
+    def tree_insert(self, key):
+        self.tree_keys.add(key)
+        if self.tree is None:
+            self.tree = [key, {}]
+            return
+        # nodes may be shared with other states, so the path to the new node is copied
+        node = self.tree = [self.tree[0], dict(self.tree[1])]
+        while True:
+            dist = Levenshtein.distance(key, node[0])
+            if dist not in node[1]:
+                node[1][dist] = [key, {}]
+                return
+            node[1][dist] = [node[1][dist][0], dict(node[1][dist][1])]
+            node = node[1][dist]
+
+    def tree_search(self, key, radius):
+        found = []
+        stack = [self.tree] if self.tree else []
+        while stack:
+            node = stack.pop()
+            dist = Levenshtein.distance(key, node[0])
+            if dist <= radius:
+                found.append(node[0])
+            for (child_dist, child) in node[1].items():
+                if dist - radius <= child_dist <= dist + radius:
+                    stack.append(child)
+        return found
+
+    def add(self, entry, order=None):
+        if order is None:
+            order = self.next_order
+            self.next_order += 1
+        self.order[id(entry)] = order
+        key = entry["ID"].lower()
+        if key not in self.keys:
+            bisect.insort(self.sorted_keys, key)
+            for gram in trigrams(key):
+                self.owned("grams", gram, set).add(key)
+            if key not in self.tree_keys:
+                self.tree_insert(key)
+        self.owned("keys", key, dict)[id(entry)] = entry
+
+    def remove(self, entry):
+        key = entry["ID"].lower()
+        matches = self.owned("keys", key, dict)
+        matches.pop(id(entry), None)
+        if len(matches) == 0:
+            del self.keys[key]
+            del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+            for gram in trigrams(key):
+                grams = self.owned("grams", gram, set)
+                grams.discard(key)
+                if len(grams) == 0:
+                    del self.grams[gram]
+            if len(self.tree_keys) > 2 * len(self.keys):
+                self.tree = None
+                self.tree_keys = set()
+                for k in self.keys:
+                    self.tree_insert(k)
+        return self.order.pop(id(entry), None)
+
+    def replace(self, old, new):
+        self.add(new, self.remove(old))
+
+    def suggestions(self, key):
+        key_lower = key.lower()
+        grams = trigrams(key_lower)
+        if len(grams) > 0:
+            found = set.intersection(*[self.grams.get(gram, set()) for gram in grams])
+        else:
+            found = set(k for k in self.keys if key_lower in k)
+        if len(key_lower) >= 15:
+            size = len(key_lower) / 5.0
+            for i in range(5):
+                part = key_lower[int(i * size):int((i + 1) * size)]
+                found.update(set.intersection(*[self.grams.get(gram, set()) for gram in trigrams(part)]))
+        else:
+            found.update(self.tree_search(key_lower, 4))
+        if len(key_lower) >= 6:
+            prefix = key_lower[:6]
+            idx = bisect.bisect_left(self.sorted_keys, prefix)
+            while idx < len(self.sorted_keys) and self.sorted_keys[idx].startswith(prefix):
+                found.add(self.sorted_keys[idx])
+                idx += 1
+        entries = []
+        for k in found:
+            for entry in self.keys.get(k, {}).values():
+                score = suggest_score(entry["ID"], key)
+                if score is not None:
+                    entries.append((score, entry))
+        return sorted(entries, key=lambda x: self.order[id(x[1])])
+
+
+class RealmState:
+    """A realm's database and all indexes derived from it, never modified once published."""
+
+    def __init__(self, db, previous=None, saved=None):
+        """Builds the indexes, or takes them from saved, the export() of an earlier state."""
+        saved = saved or {}
+        self.db = db
+        self.by_key = {}  # ID -> [entries with this ID, in file order]
+        for entry in db.entries:
+            self.by_key.setdefault(entry["ID"], []).append(entry)
+        self.dups = DuplicateIndex(db.entries, saved.get("tokens"))
+        self.search = SearchIndex(db.entries, saved.get("postings"))
+        self.suggest = SuggestIndex(db.entries)
+        self.render = RenderCache(db.entries, previous.render if previous else None, saved.get("rendered"))
+        self.base = None  # hash of the main.bib this state was read from or written to
+        self.digest = None  # base, chained with the journal records written since
+        self.changes = []  # modifications since the state was copied, see save_bib()
+        self.size = estimate_size(self)  # approximate memory in bytes, updated with entry_size() on writes
+        self.freeze()
+
+    def export(self, entries=None):
+        """The database and the expensive parts of the indexes as plain values for marshal."""
+        if entries is None:
+            entries = self.db.entries
+        return {
+            "entries": entries,
+            "comments": self.db.comments,
+            "preambles": self.db.preambles,
+            "strings": list(self.db.strings.items()),
+            "tokens": self.dups.export(entries),
+            "postings": self.search.export(entries),
+            "rendered": self.render.export(entries),
+        }
+
+    def copy(self):
+        clone = object.__new__(RealmState)
+        clone.db = bibtexparser.bibdatabase.BibDatabase()
+        clone.db.entries = list(self.db.entries)
+        clone.db.comments = list(self.db.comments)
+        clone.db.preambles = list(self.db.preambles)
+        clone.db.strings = self.db.strings.copy()
+        clone.by_key = dict(self.by_key)
+        clone.dups = self.dups.copy()
+        clone.search = self.search.copy()
+        clone.suggest = self.suggest.copy()
+        clone.render = self.render.copy()
+        clone.base = self.base
+        clone.digest = self.digest
+        clone.changes = []
+        clone.size = self.size
+        return clone
+
+    def freeze(self):
+        for index in [self.dups, self.search, self.suggest, self.render]:
+            index.freeze()
+
+    def lookup(self, key):
+        matches = self.by_key.get(key)
+        if matches:
+            return matches[0]
+        return None
+
+    def key_position(self, entry):
+        """Position of entry among the entries with its ID, the same as in main.bib."""
+        return next(idx for (idx, e) in enumerate(self.by_key[entry["ID"]]) if e is entry)
+
+    def index_add(self, entry, order=None):
+        self.by_key[entry["ID"]] = self.by_key.get(entry["ID"], []) + [entry]
+        self.dups.add(entry, order)
+        self.search.add(entry)
+        self.suggest.add(entry, order)
+
+    def index_remove(self, entry):
+        matches = [e for e in self.by_key.get(entry["ID"], []) if e is not entry]
+        if len(matches) == 0:
+            self.by_key.pop(entry["ID"], None)
+        else:
+            self.by_key[entry["ID"]] = matches
+        self.search.remove(entry)
+        self.suggest.remove(entry)
+        self.render.remove(entry)
+        return self.dups.remove(entry)
+
+    def position(self, entry):
+        """Position of entry in db.entries, by identity like in the indexes, as equal entries may be in the realm twice."""
+        return next(idx for (idx, e) in enumerate(self.db.entries) if e is entry)
+
+    def add(self, entry):
+        self.db.entries.append(entry)
+        self.index_add(entry)
+        self.changes.append(("add", None, entry, None))
+        self.size += entry_size(entry)
+
+    def replace(self, old, new):
+        self.changes.append(("replace", old, new, self.key_position(old)))
+        self.size += entry_size(new) - entry_size(old)
+        entries = self.db.entries
+        if old["ID"] == new["ID"]:
+            # keep the position among entries sharing this key
+            entries[self.position(old)] = new
+            self.by_key[old["ID"]] = [new if e is old else e for e in self.by_key[old["ID"]]]
+            self.dups.replace(old, new)
+            self.search.replace(old, new)
+            self.suggest.replace(old, new)
+            self.render.remove(old)
+        else:
+            # like an added entry, it comes last among the entries with its new key
+            del entries[self.position(old)]
+            entries.append(new)
+            self.index_remove(old)
+            self.index_add(new)
+
+    def remove(self, entry):
+        self.changes.append(("remove", entry, None, self.key_position(entry)))
+        self.size -= entry_size(entry)
+        del self.db.entries[self.position(entry)]
+        self.index_remove(entry)
+
+
+def realm_lock(realm):
+    with realm_locks_lock:
+        return realm_locks.setdefault(realm, threading.RLock())
+
+
+def realm_state():
+    """The state of the request's realm, taken once per request."""
     realm = get_realm()
     ensure_realm_loaded(realm)
-    dups = []
-    for e in bib_database[realm].entries:
-        dist = 0
-        fields = set(e.keys())
-        fields.update(entry.keys())
+    states = g.setdefault("realm_states", {})
+    if realm not in states:
+        states[realm] = realms[realm]
+    return states[realm]
+
+
+def publish_state(realm, state):
+    state.freeze()
+    with realm_usage_lock:
+        realm_sizes[realm] = state.size
+    realms[realm] = state
+    if has_app_context():
+        g.setdefault("realm_states", {})[realm] = state
+
+
+@contextlib.contextmanager
+def write_state():
+    """Holds the realm lock and yields a copy of the realm state, published when the block succeeds."""
+    realm = get_realm()
+    ensure_realm_loaded(realm)
+    with realm_lock(realm):
+        state = realms[realm].copy()
+        states = g.setdefault("realm_states", {})
+        states[realm] = state
+        try:
+            yield state
+        except:
+            states[realm] = realms[realm]
+            raise
+        publish_state(realm, state)
+    schedule_eviction(realm)
+
+
+def get_duplicates(entry):
+    with timed("duplicates"):
+        return batch_duplicates([entry], realm_state())[0]
+
+
+def duplicate_scores(entry, candidates):
+    found = []
+    comparisons = 0
+    for (idx, e) in enumerate(candidates):
+        fields = [field for field in e if field in entry]
+        if e["ID"] == entry["ID"]:
+            dist = sum(Levenshtein.distance(e[field], entry[field]) for field in fields)
+            comparisons += len(fields)
+            if dist > 0 or sorted(e.keys()) != sorted(entry.keys()):
+                found.append((idx, dist))
+            continue
         length = 0
-        exact = e["ID"] == entry["ID"]
+        difference = 0  # the distance is at least the difference of the lengths
         for field in fields:
-            if field in e and field in entry:
-                dist += Levenshtein.distance(e[field], entry[field])
-                length += max(len(e[field]), len(entry[field]))
-        if (exact and sorted(e.keys()) != sorted(entry.keys())) or ((dist < max(5, length * 0.1) or exact) and dist > 0):
-            dups.append((dist, entry["ID"], e))
-    return dups
+            a = len(e[field])
+            b = len(entry[field])
+            length += a if a > b else b
+            difference += a - b if a > b else b - a
+        budget = math.ceil(max(5, length * 0.1)) - 1
+        if difference > budget:
+            continue
+        dist = 0
+        for field in fields:
+            dist += Levenshtein.distance(e[field], entry[field], score_cutoff=budget - dist)
+            comparisons += 1
+            if dist > budget:
+                break
+        if 0 < dist <= budget:
+            found.append((idx, dist))
+    return (found, comparisons)
+
+
+def score_duplicates(jobs):
+    return [duplicate_scores(entry, candidates) for (entry, candidates) in jobs]
+
+
+def duplicate_process_pool():
+    global duplicate_pool
+    if duplicate_workers <= 1:
+        return None
+    with duplicate_pool_lock:
+        if duplicate_pool is None:
+            # spawned, as forking a server with running threads is not safe
+            duplicate_pool = ProcessPoolExecutor(max_workers=duplicate_workers, mp_context=multiprocessing.get_context("spawn"))
+        return duplicate_pool
+
+
+def batch_duplicates(entries, state):
+    jobs = []
+    narrowed = []  # positions of the jobs whose candidates are not the whole realm
+    for entry in entries:
+        candidates = state.dups.candidates(entry, state.search)
+        if candidates is not None:
+            narrowed.append(len(jobs))
+        jobs.append((entry, state.db.entries if candidates is None else candidates))
+    pairs = sum(len(candidates) for (_, candidates) in jobs)
+    # a job with the whole realm would pickle it for every chunk, it is scored here
+    pool = duplicate_process_pool() if sum(len(jobs[idx][1]) for idx in narrowed) >= parallel_duplicates else None
+    if pool:
+        size = max(1, len(narrowed) // (4 * duplicate_workers))
+        chunks = [[jobs[idx] for idx in narrowed[i:i + size]] for i in range(0, len(narrowed), size)]
+        scores = [None] * len(jobs)
+        parallel = pool.map(score_duplicates, chunks)
+        # scored while the processes score the others
+        parallel_jobs = set(narrowed)
+        for (idx, job) in enumerate(jobs):
+            if idx not in parallel_jobs:
+                scores[idx] = duplicate_scores(*job)
+        for (idx, score) in zip(narrowed, (score for chunk in parallel for score in chunk)):
+            scores[idx] = score
+    else:
+        scores = score_duplicates(jobs)
+    realm = get_realm()
+    increment("bibtool_entries_scanned_total", pairs, realm=realm, operation="duplicates")
+    increment("bibtool_levenshtein_comparisons_total", sum(comparisons for (_, comparisons) in scores), realm=realm)
+    return [[(dist, entry["ID"], candidates[idx]) for (idx, dist) in found] for ((entry, candidates), (found, _)) in zip(jobs, scores)]
 
 
 def entry_by_key(key):
-    realm = get_realm()
-    ensure_realm_loaded(realm)
-    for entry in bib_database[realm].entries:
-        if entry["ID"] == key:
-            return entry
+    return realm_state().lookup(key)
+
+
+def write_file(path, content):
+    """Replaces the file atomically and only returns once the content is on disk."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".bibtool-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(content)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class WritePipeline:
+    def __init__(self, realm):
+        self.realm = realm
+        self.cond = threading.Condition()
+        self.git_lock = threading.Lock()  # held for every git operation on the realm
+        self.pending = []
+        self.first_pending = None
+        self.committing = 0  # writes taken from pending whose commit did not finish yet
+        self.unpushed = 0
+        self.unpushed_since = None
+        self.push_failures = 0
+        self.push_backoff = 1
+        self.next_push = 0
+        self.last_push_error = None
+        self.closed = False
+        try:
+            # commits left unpushed by an earlier pipeline of the realm
+            self.unpushed = int(repo[realm].git.rev_list("--count", "@{u}..HEAD"))
+            if self.unpushed > 0:
+                self.unpushed_since = time.time()
+        except Exception:
+            pass
+        thread = threading.Thread(target=self.run, name="pipeline-%s" % realm, daemon=True)
+        thread.start()
+
+    def submit(self, message):
+        with self.cond:
+            if len(self.pending) == 0:
+                self.first_pending = time.time()
+            self.pending.append(message)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    if len(self.pending) > 0:
+                        if now >= self.first_pending + commit_window:
+                            break
+                        self.cond.wait(self.first_pending + commit_window - now)
+                    elif self.closed:
+                        return
+                    elif self.unpushed > 0:
+                        if now >= self.next_push:
+                            break
+                        self.cond.wait(self.next_push - now)
+                    else:
+                        self.cond.wait()
+                messages = self.pending
+                self.pending = []
+                self.committing += len(messages)
+            if len(messages) > 0:
+                self.commit(messages)
+            if self.unpushed > 0 and time.time() >= self.next_push:
+                self.push()
+
+    def commit(self, messages):
+        bib_path = os.path.join(repo_path, self.realm, repo_name)
+        try:
+            with self.git_lock, timed("commit", self.realm):
+                repo[self.realm].index.add([bib_path])
+                repo[self.realm].index.commit("[BibTool] %s" % "\n".join(messages))
+        except Exception as e:
+            print("Error: could not commit to repository (%s)" % e)
+            with self.cond:
+                self.committing -= len(messages)
+            return
+        forget_committed(self.realm, messages)
+        with self.cond:
+            self.committing -= len(messages)
+            self.unpushed += 1
+            if self.unpushed_since is None:
+                self.unpushed_since = time.time()
+            # commits of flush() are pushed by the thread
+            self.cond.notify()
+
+    def push(self, rebase=True):
+        with self.cond:
+            count = self.unpushed
+        try:
+            with self.git_lock, timed("push", self.realm):
+                result = repo[self.realm].remotes.origin.push()
+            if rebase and any(info.flags & info.REJECTED for info in result):
+                # the remote has commits that were pushed by someone else, sync_realm() rebases
+                # the realm's commits onto them and pushes again. The realm lock is taken
+                # without the git lock, like everywhere else
+                with realm_lock(self.realm):
+                    sync_realm(self.realm)
+                return
+            result.raise_if_error()
+        except Exception as e:
+            print("Warning: could not push to repository")
+            increment("bibtool_push_failures_total", realm=self.realm)
+            with self.cond:
+                self.push_failures += 1
+                self.last_push_error = str(e)
+                self.next_push = time.time() + self.push_backoff
+                self.push_backoff = min(2 * self.push_backoff, push_backoff_max)
+            return
+        with self.cond:
+            self.unpushed = max(0, self.unpushed - count)
+            if self.unpushed == 0:
+                self.unpushed_since = None
+            self.push_backoff = 1
+            self.last_push_error = None
+
+    def flush(self, push=False):
+        if not repo.get(self.realm) or no_commit:
+            return
+        with self.cond:
+            messages = self.pending
+            self.pending = []
+            self.committing += len(messages)
+        bib_path = os.path.join(repo_path, self.realm, repo_name)
+        if len(messages) == 0 and repo[self.realm].is_dirty(path=bib_path):
+            messages = ["Recovered uncommitted changes"]
+            with self.cond:
+                self.committing += 1
+        if len(messages) > 0:
+            self.commit(messages)
+        if push and self.unpushed > 0:
+            self.push()
+
+    def idle(self):
+        with self.cond:
+            return len(self.pending) == 0 and self.committing == 0 and self.unpushed == 0
+
+    def close(self):
+        """Stops the thread once everything is committed."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def status(self):
+        with self.cond:
+            return {
+                "pending_writes": len(self.pending),
+                "unpushed_commits": self.unpushed,
+                "push_lag": time.time() - self.unpushed_since if self.unpushed_since else 0,
+                "push_failures": self.push_failures,
+                "last_push_error": self.last_push_error,
+            }
+
+
+def write_pipeline(realm):
+    with pipelines_lock:
+        if realm not in pipelines:
+            pipelines[realm] = WritePipeline(realm)
+        return pipelines[realm]
+
+
+@atexit.register
+def flush_pipelines():
+    with pipelines_lock:
+        realms = list(pipelines.values())
+    for pipeline in realms:
+        pipeline.flush()
+
+
+def snapshot_path(realm):
+    return os.path.join(cache_path, realm, repo_name + ".snapshot")
+
+
+def journal_path(realm):
+    return os.path.join(repo_path, realm, "." + repo_name + ".journal")
+
+
+def read_realm_state(realm, previous=None):
+    return replay_journal(realm, read_bib_state(realm, previous))
+
+
+def read_bib_state(realm, previous=None):
+    """Loads the realm's main.bib, from the snapshot if it was taken of the same content."""
+    bib_path = os.path.join(repo_path, realm, repo_name)
+    try:
+        with open(bib_path, "rb") as bibtex_file:
+            content = bibtex_file.read()
+    except Exception:
+        return RealmState(bibtexparser.bibdatabase.BibDatabase(), previous)
+    digest = hashlib.sha256(content).hexdigest()
+    try:
+        with open(snapshot_path(realm), "rb") as snapshot_file:
+            # the header is read first, so an outdated snapshot is not loaded completely
+            if marshal.load(snapshot_file) == (SNAPSHOT_VERSION, digest):
+                snapshot = marshal.load(snapshot_file)
+                db = bibtexparser.bibdatabase.BibDatabase()
+                db.entries = snapshot["entries"]
+                db.comments = snapshot["comments"]
+                db.preambles = snapshot["preambles"]
+                db.strings = collections.OrderedDict(snapshot["strings"])
+                state = RealmState(db, previous, snapshot)
+                state.base = state.digest = digest
+                return state
+    except Exception:
+        pass
+    try:
+        db = parse_bibtex(content.decode("utf-8"))
+    except Exception:
+        return RealmState(bibtexparser.bibdatabase.BibDatabase(), previous)
+    state = RealmState(db, previous)
+    state.base = state.digest = digest
+    schedule_snapshot(realm, state, digest)
+    return state
+
+
+def chain_digest(digest, line):
+    return hashlib.sha256((digest or "").encode("utf-8") + line).hexdigest()
+
+
+def journal_record(change):
+    """The journal record of a change, the old entry is identified by its ID and position among that ID's entries."""
+    op, old, new, position = change
+    record = {"op": op}
+    if old is not None:
+        record["id"] = old["ID"]
+        record["index"] = position
+    if new is not None:
+        record["entry"] = new
+    return record
+
+
+def apply_record(state, record):
+    if record["op"] == "add":
+        state.add(record["entry"])
+        return True
+    matches = state.by_key.get(record["id"], [])[record["index"]:record["index"] + 1]
+    if len(matches) == 0:
+        return False
+    if record["op"] == "replace":
+        state.replace(matches[0], record["entry"])
+    else:
+        state.remove(matches[0])
+    return True
+
+
+def journal_header(state, pending):
+    """The first line of a journal: base, revision, and the commit messages not committed yet."""
+    header = {"base": state.base, "digest": state.digest}
+    if len(pending) > 0:
+        header["pending"] = pending
+    return json.dumps(header).encode("utf-8") + b"\n"
+
+
+def append_line(path, line):
+    with open(path, "ab") as journal_file:
+        journal_file.write(line + b"\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+        return journal_file.tell()
+
+
+def replay_journal(realm, state):
+    """Applies the realm's journal to a copy of state, unless it was written on top of another main.bib."""
+    path = journal_path(realm)
+    try:
+        with open(path, "rb") as journal_file:
+            lines = journal_file.read().split(b"\n")
+        header = json.loads(lines[0])
+    except Exception:
+        return state
+    if header.get("base") != state.base:
+        return recover_folded(realm, state, lines, header)
+    resubmit_pending(realm, header.get("pending", []))
+    state.digest = header["digest"]
+    messages = []
+    offset = len(lines[0]) + 1
+    for line in lines[1:]:
+        try:
+            write = json.loads(line)
+        except ValueError:
+            if line:
+                # the server stopped while appending this write, it was never acknowledged
+                os.truncate(path, offset)
+            break
+        if "fold" in write:
+            # compact_journal() did not write main.bib
+            offset += len(line) + 1
+            continue
+        if len(messages) == 0:
+            state = state.copy()
+        for record in write["changes"]:
+            if not apply_record(state, record):
+                print("Warning: journal of realm %s changes a missing entry %s" % (realm, record["id"]))
+        state.digest = chain_digest(state.digest, line)
+        messages.append(write["message"])
+        offset += len(line) + 1
+    if len(messages) > 0:
+        state.changes = []
+        state.freeze()
+        print("Replayed %d writes from the journal of realm %s" % (len(messages), realm))
+        with journals_lock:
+            journals[realm] = messages
+        schedule_compaction(realm, 0)
+    return state
+
+
+def recover_folded(realm, state, lines, header):
+    """Commits the messages of a journal that was folded into main.bib just before a crash."""
+    digest = header.get("digest")
+    messages = list(header.get("pending", []))
+    for line in lines[1:]:
+        try:
+            write = json.loads(line)
+        except ValueError:
+            break
+        if write.get("fold") == state.base:
+            state.digest = digest
+            resubmit_pending(realm, messages)
+            with journals_lock:
+                pending = list(folded.get(realm, []))
+            write_file(journal_path(realm), journal_header(state, pending))
+            print("Recovered %d folded writes from the journal of realm %s" % (len(messages), realm))
+            return state
+        if "fold" not in write:
+            digest = chain_digest(digest, line)
+            messages.append(write["message"])
+    return state
+
+
+def resubmit_pending(realm, messages):
+    """Commits the writes a stopped server folded into main.bib but did not commit."""
+    if len(messages) == 0 or not repo.get(realm) or no_commit:
+        return
+    with journals_lock:
+        if realm in folded:
+            # submitted by this process before
+            return
+        folded[realm] = list(messages)
+    bib_path = os.path.join(repo_path, realm, repo_name)
+    try:
+        dirty = repo[realm].is_dirty(path=bib_path)
+    except Exception:
+        dirty = True
+    if not dirty:
+        # the server stopped after the commit, before it removed them from the journal
+        with journals_lock:
+            folded[realm] = []
+        return
+    pipeline = write_pipeline(realm)
+    for msg in messages:
+        pipeline.submit(msg)
+
+
+def forget_committed(realm, messages):
+    with realm_lock(realm):
+        with journals_lock:
+            pending = folded.get(realm, [])
+            if len(messages) == 0 or pending[:len(messages)] != messages:
+                return
+            pending = folded[realm] = pending[len(messages):]
+        path = journal_path(realm)
+        try:
+            with open(path, "rb") as journal_file:
+                first, _, rest = journal_file.read().partition(b"\n")
+            header = json.loads(first)
+            header.pop("pending", None)
+            if len(pending) > 0:
+                header["pending"] = pending
+            write_file(path, json.dumps(header).encode("utf-8") + b"\n" + rest)
+        except Exception as e:
+            print("Warning: could not update the journal of realm %s (%s)" % (realm, e))
+
+
+def append_journal(realm, state, line):
+    path = journal_path(realm)
+    with journals_lock:
+        fresh = realm not in journals
+        pending = list(folded.get(realm, []))
+    if fresh:
+        # the journal of the last compaction is replaced, it may also be missing or outdated
+        content = journal_header(state, pending) + line + b"\n"
+        write_file(path, content)
+        return len(content)
+    return append_line(path, line)
+
+
+def schedule_compaction(realm, delay):
+    timer = threading.Timer(delay, compact_journal, [realm])
+    timer.daemon = True
+    timer.start()
+
+
+def compact_journal(realm):
+    with realm_lock(realm):
+        with journals_lock:
+            messages = journals.pop(realm, None)
+        if messages is None or realm not in realms:
+            return
+        state = realms[realm].copy()
+        bib_path = os.path.join(repo_path, realm, repo_name)
+        committing = repo.get(realm) and not no_commit
+        with journals_lock:
+            pending = folded.get(realm, []) + (messages if committing else [])
+        try:
+            with timed("render", realm):
+                content = bib_to_bibtex(state).encode("utf-8")
+            with timed("write", realm):
+                state.base = hashlib.sha256(content).hexdigest()
+                # if the server stops before the journal is replaced, the fold marker tells
+                # that its writes are in main.bib (see recover_folded())
+                append_line(journal_path(realm), json.dumps({"fold": state.base}).encode("utf-8"))
+                write_file(bib_path, content)
+                write_file(journal_path(realm), journal_header(state, pending))
+        except Exception as e:
+            print("Error: could not write the bibliography of realm %s (%s)" % (realm, e))
+            with journals_lock:
+                journals[realm] = messages + journals.get(realm, [])
+            schedule_compaction(realm, compact_delay)
+            return
+        # only base changed, readers of the published state see the same content
+        state.freeze()
+        realms[realm] = state
+        # a state read from this file would have its entries in file order
+        schedule_snapshot(realm, state, state.base, file_order(state))
+        if committing:
+            with journals_lock:
+                folded[realm] = pending
+            pipeline = write_pipeline(realm)
+            for msg in messages:
+                pipeline.submit(msg)
+
+
+def parse_bibtex(text):
+    parser = BibTexParser(common_strings=True)
+    parser.ignore_nonstandard_types = False
+    parser.homogenize_fields = True
+    return bibtexparser.loads(text, parser)
+
+
+def bibtex_blocks(text):
+    entries = []
+    others = []
+    for block in re.split("(?m)^(?=@)", text):
+        block = block.rstrip()
+        match = re.match(r"@\s*(\w+)\s*[{(]\s*([^,\s]*)", block)
+        if not match:
+            # text outside of blocks is ignored by the parser
+            continue
+        if match.group(1).lower() in ["string", "preamble", "comment"]:
+            others.append(block)
+        else:
+            entries.append((match.group(2), block))
+    return entries, others
+
+
+def bibtex_batches(stream):
+    header = []
+    blocks = []
+    block = []
+    start = 1
+
+    def parse(blocks):
+        text = "".join(block_text for (line, block_text) in blocks)
+        try:
+            db = parse_bibtex("\n\n".join(header) + "\n\n" + text)
+        except Exception:
+            return [], [(line, "Could not parse the entries") for (line, block_text) in blocks]
+        header.extend(other for other in bibtex_blocks(text)[1] if re.match(r"@\s*string", other, re.I))
+        entries = [entry for entry in db.entries if entry.get("ID")]
+        # bibtexparser skips entries it cannot parse
+        parsed = collections.Counter(entry["ID"] for entry in entries)
+        invalid = []
+        for (line, block_text) in blocks:
+            match = re.match(r"@\s*(\w+)\s*[{(]\s*([^,\s]*)", block_text)
+            if not match or match.group(1).lower() in ["string", "preamble", "comment"]:
+                continue
+            if parsed[match.group(2)] > 0:
+                parsed[match.group(2)] -= 1
+            else:
+                invalid.append((line, "Could not parse entry %s" % match.group(2)))
+        return entries, invalid
+
+    for (number, line) in enumerate(stream, 1):
+        line = line.decode("utf-8", "replace")
+        if line.startswith("@") and block:
+            blocks.append((start, "".join(block)))
+            block = []
+            if len(blocks) == import_batch:
+                yield parse(blocks)
+                blocks = []
+        if not block:
+            start = number
+        block.append(line)
+    if block:
+        blocks.append((start, "".join(block)))
+    if blocks:
+        yield parse(blocks)
+
+
+def ndjson_batches(stream):
+    entries = []
+    invalid = []
+    for (number, line) in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            invalid.append((number, "Invalid JSON"))
+            continue
+        if not isinstance(entry, dict) or not all(isinstance(value, str) for value in entry.values()):
+            invalid.append((number, "An entry has to be an object with string fields"))
+        elif not entry.get("ID") or not entry.get("ENTRYTYPE"):
+            invalid.append((number, "An entry needs an ID and an ENTRYTYPE"))
+        else:
+            entries.append(entry)
+        if len(entries) == import_batch:
+            yield entries, invalid
+            entries = []
+            invalid = []
+    if entries or invalid:
+        yield entries, invalid
+
+
+def sync_entries(realm, state, old_head):
+    """Applies the changes to main.bib since old_head to a copy of state, None if they do not map to entries."""
+    bib_path = os.path.join(repo_path, realm, repo_name)
+    with open(bib_path, "rb") as bibtex_file:
+        content = bibtex_file.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if digest == state.base:
+        return state
+    try:
+        old_content = repo[realm].commit(old_head).tree[repo_name].data_stream.read()
+    except Exception:
+        return None
+    if state.base is None or hashlib.sha256(old_content).hexdigest() != state.base:
+        return None
+    old_entries, old_others = bibtex_blocks(old_content.decode("utf-8"))
+    new_entries, new_others = bibtex_blocks(content.decode("utf-8"))
+    if old_others != new_others:
+        # changed strings can change any entry
+        return None
+    removed = collections.Counter(old_entries) - collections.Counter(new_entries)
+    added = collections.Counter(new_entries) - collections.Counter(old_entries)
+    removed_blocks = [block for ((key, block), count) in removed.items() for i in range(count)]
+    added_blocks = [block for ((key, block), count) in added.items() for i in range(count)]
+    # the strings are parsed again with the changed entries, which may use them
+    header = "\n\n".join(new_others) + "\n\n"
+    try:
+        removed_db = parse_bibtex(header + "\n\n".join(removed_blocks))
+        added_db = parse_bibtex(header + "\n\n".join(added_blocks))
+    except Exception:
+        return None
+    if len(removed_db.entries) != len(removed_blocks) or len(added_db.entries) != len(added_blocks):
+        return None
+
+    state = state.copy()
+    old = []
+    for entry in removed_db.entries:
+        matches = [e for e in state.by_key.get(entry["ID"], []) if e == entry and not any(e is o for o in old)]
+        if len(matches) == 0:
+            return None
+        old.append(matches[0])
+    for entry in added_db.entries:
+        # a changed entry keeps its position
+        replaced = [o for o in old if o["ID"] == entry["ID"]]
+        if replaced:
+            state.replace(replaced[0], entry)
+            old = [o for o in old if o is not replaced[0]]
+        else:
+            state.add(entry)
+    for entry in old:
+        state.remove(entry)
+    state.base = state.digest = digest
+    state.changes = []
+    print("Synced %d changed entries of realm %s" % (len(removed_blocks) + len(added_blocks), realm))
+    return state
+
+
+def schedule_snapshot(realm, state, digest, entries=None):
+    with snapshots_lock:
+        pending = realm in snapshots
+        snapshots[realm] = (state, digest, entries)
+    if not pending:
+        timer = threading.Timer(snapshot_delay, write_snapshot, [realm])
+        timer.daemon = True
+        timer.start()
+
+
+def write_snapshot(realm):
+    with snapshots_lock:
+        if realm not in snapshots:
+            return
+        state, digest, entries = snapshots[realm]
+    try:
+        # marshal is not safe against crafted data, only the server may be able to write the snapshots
+        header = marshal.dumps((SNAPSHOT_VERSION, digest))
+        os.makedirs(os.path.dirname(snapshot_path(realm)), exist_ok=True)
+        write_file(snapshot_path(realm), header + marshal.dumps(state.export(entries)))
+    except Exception as e:
+        print("Warning: could not write snapshot of realm %s (%s)" % (realm, e))
+    with snapshots_lock:
+        # a write that came in meanwhile is snapshotted by the next timer
+        if snapshots.get(realm, (None, ))[0] is state:
+            del snapshots[realm]
+        else:
+            timer = threading.Timer(snapshot_delay, write_snapshot, [realm])
+            timer.daemon = True
+            timer.start()
+
+
+@atexit.register
+def flush_snapshots():
+    with snapshots_lock:
+        pending = list(snapshots)
+    for realm in pending:
+        write_snapshot(realm)
+
+
+@atexit.register
+def compact_journals():
+    # registered after flush_snapshots() and flush_pipelines(), so it runs before them
+    with journals_lock:
+        pending = set(journals)
+    # a realm whose journal is being compacted is not in journals, its lock waits for it
+    for realm in pending | set(realms):
+        compact_journal(realm)
+
+
+def accepted_encoding():
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        fields = part.strip().split(";")
+        if any(f.strip() in ["q=0", "q=0.0", "q=0.00", "q=0.000"] for f in fields[1:]):
+            continue
+        accepted.add(fields[0].strip().lower())
+    if zstandard and "zstd" in accepted:
+        return "zstd"
+    if "gzip" in accepted:
+        return "gzip"
     return None
 
 
+def encoded_response(chunks, mimetype, etag=None):
+    if etag and etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+        response = app.response_class(status=304)
+        response.headers["ETag"] = etag
+        return response
+    encoding = accepted_encoding()
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor().compressobj()
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = None
+
+    def generate():
+        buffered = []
+        size = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            size += len(chunk)
+            if size < 65536:
+                continue
+            data = "".join(buffered).encode("utf-8")
+            buffered = []
+            size = 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+        data = "".join(buffered).encode("utf-8")
+        yield compressor.compress(data) + compressor.flush() if compressor else data
+
+    response = app.response_class(stream_with_context(generate()), mimetype=mimetype)
+    g.streaming = True
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def realm_revision():
+    """The hash of the realm's main.bib chained with its journal records, None without a file."""
+    digest = realm_state().digest
+    return digest[:16] if digest else None
+
+
+def request_etag():
+    """ETag of a bulk fetch, which only depends on the realm revision and the request."""
+    revision = realm_revision()
+    if not revision:
+        return None
+    query = json.dumps([request.path, request.json.get("entries"), request.json.get("known")], sort_keys=True)
+    return 'W/"%s-%s"' % (revision, hashlib.sha1(query.encode("utf-8")).hexdigest()[:16])
+
+
+def fetch_entry(key, known):
+    entry = entry_by_key(key)
+    if entry and key in known and known[key] == entry_hash(entry):
+        return True
+    return entry
+
+
+def json_list(items):
+    yield "["
+    for (idx, item) in enumerate(items):
+        yield ("," if idx > 0 else "") + app.json.dumps(item)
+    yield "]"
+
+
 def save_bib(commit_message = None, token = None):
     realm = get_realm()
     ensure_realm_loaded(realm)
-    import os
-    global repo_path, repo_name
-    bib_path = os.path.join(repo_path, realm, repo_name)
-    with open(bib_path, "w") as bibtex_file:
-        bibtexparser.dump(bib_database[realm], bibtex_file)
-    if repo[realm] and not no_commit:
-        msg = commit_message if commit_message else "update"
-        if tokens:
-            msg += " (Token %s)" % (token if token else "none")
-        msg = "[BibTool] %s" % msg
-        repo[realm].index.add([bib_path])
-        repo[realm].index.commit(msg)
-        try:
-            repo[realm].remotes.origin.push()
-        except:
-            print("Warning: could not push to repository")
+    state = realm_state()
+    msg = commit_message if commit_message else "update"
+    if tokens:
+        msg += " (Token %s)" % (token if token else "none")
+    line = json.dumps({"message": msg, "changes": [journal_record(change) for change in state.changes]}).encode("utf-8")
+    state.changes = []
+    with timed("write", realm):
+        size = append_journal(realm, state, line)
+    state.digest = chain_digest(state.digest, line)
+    with journals_lock:
+        pending = realm in journals
+        journals.setdefault(realm, []).append(msg)
+    if not pending:
+        schedule_compaction(realm, compact_delay)
+    elif size >= compact_size > size - len(line) - 1:
+        schedule_compaction(realm, 0)
 
 def entry_is_same(e1, e2):
     if set(e1.keys()) != set(e2.keys()):
@@ -111,6 +1618,120 @@ def entry_is_same(e1, e2):
     return True
 
 
+class PolicyRealm:
+    def __init__(self, state, deadline):
+        self._state = state
+        self.deadline = deadline
+
+    @property
+    def entries(self):
+        return tuple(self._state.db.entries)
+
+    def by_id(self, key):
+        return tuple(self._state.by_key.get(key, ()))
+
+    def by_doi(self, doi):
+        return tuple(self._state.dups.blocks.get(("doi", normalize_doi(doi)), {}).values())
+
+    def by_title(self, title):
+        return tuple(self._state.dups.blocks.get(("title", " ".join(sorted(field_tokens(title)))), {}).values())
+
+    def time_left(self):
+        return self.deadline - time.time()
+
+
+def check_batch_v1(policy, entries, realm):
+    database = list(realm.entries)
+    results = []
+    for entry in entries:
+        accept, reason = policy.check(entry, database)
+        if accept:
+            database.append(entry)
+        results.append((accept, reason))
+    return results
+
+
+def run_policy(policy, entries, realm):
+    if hasattr(policy, "check_batch"):
+        return list(policy.check_batch(entries, realm))
+    return check_batch_v1(policy, entries, realm)
+
+
+def new_policy_stats():
+    return {"calls": 0, "entries": 0, "rejects": 0, "timeouts": 0, "skipped": 0, "seconds": 0.0, "running": 0, "overrunning": 0}
+
+
+def policy_finished(name, counter):
+    with policy_stats_lock:
+        policy_stats[name][counter] -= 1
+
+
+def start_policy(policy, entries, realm):
+    """Submits a policy call to the policy's threads, None if all of them are stuck in calls past their budget."""
+    name = policy.__name__
+    with policy_stats_lock:
+        stats = policy_stats.setdefault(name, new_policy_stats())
+        if stats["overrunning"] >= policy_workers:
+            stats["skipped"] += 1
+            return None
+        if name not in policy_pools:
+            policy_pools[name] = ThreadPoolExecutor(max_workers=policy_workers, thread_name_prefix="policy-%s" % name)
+        pool = policy_pools[name]
+        stats["running"] += 1
+    future = pool.submit(run_policy, policy, entries, realm)
+    future.add_done_callback(lambda future: policy_finished(name, "running"))
+    return future
+
+
+def check_policies(entries, deadline=None):
+    """(accept, reason) for each entry, entries not checked within policy_budget or until deadline are rejected."""
+    with timed("policy"):
+        # a call keeps reading the realm after its timeout, so it gets the published state, which the
+        # writer holding the realm lock has not changed yet, and not the writer's copy
+        return run_policies(entries, realms[get_realm()], deadline or time.time() + policy_budget)
+
+
+def run_policies(entries, state, deadline):
+    results = [(True, None)] * len(entries)
+    realm = PolicyRealm(state, deadline)
+    for policy in policies:
+        name = policy.__name__
+        todo = [idx for (idx, result) in enumerate(results) if result[0]]
+        if len(todo) == 0:
+            break
+        start = time.time()
+        future = start_policy(policy, [entries[idx] for idx in todo], realm)
+        if future is None:
+            print("Policy %s is stuck in earlier calls" % name)
+            for idx in todo:
+                results[idx] = (False, "Policy check is not available.")
+            break
+        timeout = False
+        try:
+            checked = future.result(timeout=max(0, deadline - start))
+        except FutureTimeout:
+            timeout = True
+            checked = [(False, "Policy check did not finish in time.")] * len(todo)
+            if not future.cancel():
+                # the call keeps one of the policy's threads busy until it returns
+                with policy_stats_lock:
+                    policy_stats[name]["overrunning"] += 1
+                future.add_done_callback(lambda future: policy_finished(name, "overrunning"))
+        for (idx, result) in zip(todo, checked):
+            results[idx] = result
+        with policy_stats_lock:
+            stats = policy_stats.setdefault(name, new_policy_stats())
+            stats["calls"] += 1
+            stats["entries"] += len(todo)
+            stats["rejects"] += sum(1 for result in checked if not result[0])
+            stats["timeouts"] += int(timeout)
+            stats["seconds"] += time.time() - start
+        if timeout:
+            print("Policy %s did not finish in time" % name)
+            break
+    return results
+
+
 @app.route("/")
 def index():
     return "BibTool v1<br/>\n<a href=\"v1/client.py\">Download client</a><br/>\n<a href=\"v1/requirements.txt\">Download requirements.txt</a>"
@@ -143,7 +1764,7 @@ def get_bibentry(key, token):
     ok, reason = check_token(token, "read")
     if not ok:
         return reason["message"]
-    return entry_to_bibtex(entry_by_key(key))
+    return render_entry(entry_by_key(key))
 
 
 @app.route("/v1/get", methods=["POST"])
@@ -156,11 +1777,8 @@ def get_bibfile():
     if not ok:
         return reason["message"]
 
-    bib = ""
-    for entry in request.json["entries"]:
-        bib += entry_to_bibtex(entry_by_key(entry)) + "\n"
-
-    return bib
+    keys = request.json["entries"]
+    return encoded_response((render_entry(entry_by_key(key)) + "\n" for key in keys), "text/html", request_etag())
 
 
 @app.route("/v1/get_json", methods=["POST"])
@@ -173,50 +1791,40 @@ def get_bibfile_as_json():
     if not ok:
         return jsonify(reason)
 
-    bib = []
-    for entry in request.json["entries"]:
-        bib.append(entry_by_key(entry))
-
-    return jsonify(bib)
+    # entries whose hash the client passes in "known" are returned as true
+    known = request.json.get("known", {})
+    entries = (fetch_entry(key, known) for key in request.json["entries"])
+    return encoded_response(json_list(entries), "application/json", request_etag())
 
 
 @app.route("/v1/suggest/<string:key>", defaults={"token": None}, methods=["GET"])
 @app.route("/v1/suggest/<string:key>/<string:token>", methods=["GET"])
-def suggest_entry(key, token):
+@app.route("/v1/suggest/<string:key>/<string:token>/<string:realm>", methods=["GET"])
+def suggest_entry(key, token, realm=None):
     realm = get_realm()
     ensure_realm_loaded(realm)
     ok, reason = check_token(token, "search")
     if not ok:
         return jsonify(reason)
 
+    return jsonify({"success": True, "entries": suggest_keys(key)})
+
+
+def suggest_keys(key):
     entry = entry_by_key(key)
     if not entry:
-        entries = []
-        for entry in bib_database[realm].entries:
-            dist = Levenshtein.distance(entry["ID"].lower(), key.lower())
-            if key.lower() in entry["ID"].lower() or dist == 0:
-                entries.append((1, entry))
-                continue
-            if dist < 5:
-                entries.append((1-dist/100.0, entry))
-                continue
-            common_prefix = 0
-            for i in range(min(len(entry["ID"]), len(key))):
-                if entry["ID"].lower()[i] != key.lower()[i]:
-                    break
-                common_prefix += 1
-            if common_prefix >= 6:
-                entries.append((common_prefix/float(max(len(entry["ID"]), len(key))), entry))
+        entries = realm_state().suggest.suggestions(key)
     else:
         entries = [ (1, entry) ]
 
     top = sorted(entries, key=lambda x: x[0], reverse=True)
-    return jsonify({"success": True, "entries": top[:5]})
+    return top[:5]
 
 
 @app.route("/v1/search/<string:query>", defaults={"token": None}, methods=["GET"])
 @app.route("/v1/search/<string:query>/<string:token>", methods=["GET"])
-def search_entry(query, token):
+@app.route("/v1/search/<string:query>/<string:token>/<string:realm>", methods=["GET"])
+def search_entry(query, token, realm=None):
     realm = get_realm()
     ensure_realm_loaded(realm)
     ok, reason = check_token(token, "search")
@@ -227,19 +1835,27 @@ def search_entry(query, token):
     for q in query_parts:
         if len(q) < 3:
             return "Each query must be at least 3 characters!"
-    entries = []
-    for entry in bib_database[realm].entries:
-        found_part = [False for q in query_parts]
-        for field in entry:
-            for (idx, q) in enumerate(query_parts):
-                if field.lower() != "entrytype" and q.lower() in entry[field].lower():
-                    found_part[idx] = True
-        was_found = True
-        for q in found_part:
-            was_found &= q
-        if was_found:
-            entries.append((entry_to_bibtex(entry)))
-    return "\n".join(list(set(entries)))
+
+    def matches():
+        seen = set()
+        candidates = realm_state().search.candidates(query_parts)
+        increment("bibtool_entries_scanned_total", len(candidates), realm=realm, operation="search")
+        for entry in candidates:
+            found_part = [False for q in query_parts]
+            for field in entry:
+                for (idx, q) in enumerate(query_parts):
+                    if field.lower() != "entrytype" and q.lower() in entry[field].lower():
+                        found_part[idx] = True
+            was_found = True
+            for q in found_part:
+                was_found &= q
+            if not was_found:
+                continue
+            bibtex = render_entry(entry)
+            if bibtex not in seen:
+                yield bibtex if len(seen) == 0 else "\n" + bibtex
+                seen.add(bibtex)
+    return encoded_response(matches(), "text/html")
 
 
 @app.route("/v1/entry/<string:key>", methods=["POST"])
@@ -260,19 +1876,20 @@ def add_entry(key):
     if "ID" not in request.json["entry"]:
         request.json["entry"]["ID"] = key
 
-    existing = entry_by_key(request.json["entry"]["ID"])
-    if existing:
-        return jsonify({"success": False, "reason": "exists", "entry": existing})
+    with write_state() as state:
+        existing = state.lookup(request.json["entry"]["ID"])
+        if existing:
+            return jsonify({"success": False, "reason": "exists", "entry": existing})
 
-    if policy and "force" not in request.json:
-        accept, reason = policy.check(request.json["entry"], bib_database[realm].entries)
-        if not accept:
-            entry = request.json["entry"]
-            entry["reason"] = reason
-            return jsonify({"success": False, "reason": "policy", "entries": [entry]})
+        if policies and "force" not in request.json:
+            accept, reason = check_policies([request.json["entry"]])[0]
+            if not accept:
+                entry = request.json["entry"]
+                entry["reason"] = reason
+                return jsonify({"success": False, "reason": "policy", "entries": [entry]})
 
-    bib_database[realm].entries.append(request.json["entry"])
-    save_bib("Added %s" % request.json["entry"]["ID"], request.json["token"])
+        state.add(request.json["entry"])
+        save_bib("Added %s" % request.json["entry"]["ID"], request.json["token"])
     return jsonify({"success": True})
 
 
@@ -286,16 +1903,17 @@ def replace_entry(key):
     if not ok:
         return jsonify(reason)
 
-    if policy and "force" not in request.json:
-        accept, reason = policy.check(request.json["entry"], bib_database[realm].entries)
-        if not accept:
-            entry = request.json["entry"]
-            entry["reason"] = reason
-            return jsonify({"success": False, "reason": "policy", "entries": [entry]})
-
-    for (idx, entry) in enumerate(bib_database[realm].entries):
-        if entry["ID"] == key:
-            bib_database[realm].entries[idx] = request.json["entry"]
+    with write_state() as state:
+        if policies and "force" not in request.json:
+            accept, reason = check_policies([request.json["entry"]])[0]
+            if not accept:
+                entry = request.json["entry"]
+                entry["reason"] = reason
+                return jsonify({"success": False, "reason": "policy", "entries": [entry]})
+
+        entry = state.lookup(key)
+        if entry:
+            state.replace(entry, request.json["entry"])
             save_bib("Changed %s" % key, request.json["token"])
             return jsonify({"success": True})
 
@@ -311,9 +1929,10 @@ def remove_entry(key, token):
     if not ok:
         return jsonify(reason)
 
-    for (idx, entry) in enumerate(bib_database[realm].entries):
-        if entry["ID"] == key:
-            del bib_database[realm].entries[idx]
+    with write_state() as state:
+        entry = state.lookup(key)
+        if entry:
+            state.remove(entry)
             save_bib("Deleted %s" % key, token)
             return jsonify({"success": True})
 
@@ -335,34 +1954,7 @@ def add_entries():
         if not ok:
             return jsonify(reason)
 
-    dups = []
-    changes = False
-    changelog = []
-    rejects = []
-    for entry in request.json["entries"]:
-        existing = entry_by_key(entry["ID"])
-        if existing and entry_is_same(existing, entry):
-            continue
-
-        dup = get_duplicates(entry)
-        if len(dup) == 0:
-            # new entry, add
-            if not entry_by_key(entry["ID"]):
-                if policy and "force" not in request.json:
-                    accept, reason = policy.check(entry, bib_database[realm].entries)
-                    if not accept:
-                        entry["reason"] = reason
-                        rejects.append(entry)
-                        print("Rejecting entry %s" % entry["ID"])
-                        continue
-                bib_database[realm].entries.append(entry)
-                changelog.append("Added %s" % entry["ID"])
-                changes = True
-        else:
-            dups += dup
-
-    if changes:
-        save_bib("\n".join(changelog), request.json["token"])
+    rejects, dups = update_entries(request.json["entries"], request.json["token"], "force" in request.json)
 
     if len(rejects) > 0:
         return jsonify({"success": False, "reason": "policy", "entries": rejects})
@@ -373,28 +1965,239 @@ def add_entries():
     return jsonify({"success": True})
 
 
+def update_entries(entries, token, force=False, imported=False):
+    with write_state() as state:
+        # all changed entries are scored at once, against the realm before this upload
+        changed = [entry for entry in entries if not (state.lookup(entry["ID"]) and entry_is_same(state.lookup(entry["ID"]), entry))]
+        with timed("duplicates"):
+            scored = dict(zip(map(id, changed), batch_duplicates(changed, state)))
+        # only entries that are not duplicates are checked by the policies. A rejected entry is
+        # not added, so the entries of this upload that were only duplicates of it are checked then
+        verdicts = {}
+        deadline = time.time() + policy_budget
+        while True:
+            new, dups = upload_duplicates(changed, scored, state, verdicts)
+            if not policies or force:
+                break
+            todo = [entry for entry in new if id(entry) not in verdicts]
+            if len(todo) == 0:
+                break
+            verdicts.update(zip(map(id, todo), check_policies(todo, deadline)))
+            if all(verdicts[id(entry)][0] for entry in todo):
+                break
+
+        rejects = []
+        for entry in changed:
+            if id(entry) in verdicts and not verdicts[id(entry)][0]:
+                entry["reason"] = verdicts[id(entry)][1]
+                rejects.append(entry)
+                print("Rejecting entry %s" % entry["ID"])
+        for entry in new:
+            state.add(entry)
+        if len(new) > 0:
+            if imported:
+                save_bib("Imported %d entries" % len(new), token)
+            else:
+                save_bib("\n".join("Added %s" % entry["ID"] for entry in new), token)
+
+    return (rejects, dups)
+
+
+def upload_duplicates(changed, scored, state, verdicts):
+    dups = []
+    new = []
+    ids = set()
+    # entries added by this upload, they were not scored by batch_duplicates()
+    added = DuplicateIndex()
+    added_search = SearchIndex()
+    for entry in changed:
+        if id(entry) in verdicts and not verdicts[id(entry)][0]:
+            continue
+        dup = scored[id(entry)]
+        if len(new) > 0:
+            # entries added by this upload come last in file order
+            later = added.candidates(entry, added_search)
+            if later is None:
+                later = new
+            dup = dup + [(dist, entry["ID"], later[idx]) for (idx, dist) in duplicate_scores(entry, later)[0]]
+        if len(dup) > 0:
+            dups += dup
+        elif not state.lookup(entry["ID"]) and entry["ID"] not in ids:
+            new.append(entry)
+            ids.add(entry["ID"])
+            added.add(entry)
+            added_search.add(entry)
+    return (new, dups)
+
+
+@app.route("/v1/import/<string:token>", methods=["POST"])
+@app.route("/v1/import/<string:token>/<string:realm>", methods=["POST"])
+def import_entries(token, realm=None):
+    realm = get_realm()
+    ensure_realm_loaded(realm)
+    ok, reason = check_token(token, "import")
+    if not ok:
+        return jsonify(reason)
+    force = request.args.get("force") in ["1", "true"]
+    if force:
+        ok, reason = check_token(token, "force")
+        if not ok:
+            return jsonify(reason)
+    form = request.args.get("format", "bibtex")
+    if form not in ["bibtex", "ndjson"]:
+        return jsonify({"success": False, "reason": "invalid_request", "message": "Unknown format %s" % form})
+    # buffered, the request stream reads lines byte by byte
+    stream = io.BufferedReader(request.stream, 65536)
+    batches = bibtex_batches(stream) if form == "bibtex" else ndjson_batches(stream)
+    # not compressed, so every line is sent as soon as its batch is added
+    response = app.response_class(stream_with_context(import_progress(realm, batches, token, force)), mimetype="application/x-ndjson")
+    g.streaming = True
+    return response
+
+
+def import_progress(realm, batches, token, force):
+    with imports_lock:
+        if realm in imports:
+            yield app.json.dumps({"success": False, "reason": "import_running", "message": "Another import into this realm is running"}) + "\n"
+            return
+        progress = imports[realm] = {"started": time.time(), "entries": 0, "added": 0, "duplicates": 0, "rejects": 0, "invalid": 0}
+    try:
+        for (entries, invalid) in batches:
+            rejects, dups = update_entries(entries, token, force, imported=True) if entries else ([], [])
+            state = realm_state()
+            added = sum(1 for entry in entries if state.lookup(entry["ID"]) is entry)
+            with imports_lock:
+                progress["entries"] += len(entries)
+                progress["added"] += added
+                progress["duplicates"] += len(dups)
+                progress["rejects"] += len(rejects)
+                progress["invalid"] += len(invalid)
+                result = dict(progress)
+            result.update({"batch_added": added, "batch_duplicates": dups, "batch_rejects": rejects,
+                           "batch_invalid": [{"line": line, "message": message} for (line, message) in invalid]})
+            yield app.json.dumps(result) + "\n"
+        with imports_lock:
+            result = dict(progress)
+        result["success"] = True
+        yield app.json.dumps(result) + "\n"
+    except Exception as e:
+        print("Error: import into realm %s failed (%s)" % (realm, e))
+        yield app.json.dumps({"success": False, "reason": "server_problem", "message": "The import stopped: %s" % e}) + "\n"
+    finally:
+        with imports_lock:
+            imports.pop(realm, None)
+
+
+@app.route("/v1/export/<string:token>", methods=["GET"])
+@app.route("/v1/export/<string:token>/<string:realm>", methods=["GET"])
+def export_entries(token, realm=None):
+    ok, reason = check_token(token, "export")
+    if not ok:
+        return jsonify(reason)
+    form = request.args.get("format", "bibtex")
+    if form not in ["bibtex", "ndjson"]:
+        return jsonify({"success": False, "reason": "invalid_request", "message": "Unknown format %s" % form})
+    state = realm_state()
+    revision = realm_revision()
+    etag = 'W/"%s-%s"' % (revision, form) if revision else None
+    if form == "bibtex":
+        return encoded_response(bibtex_chunks(state), "application/x-bibtex", etag)
+    return encoded_response((app.json.dumps(entry) + "\n" for entry in file_order(state)), "application/x-ndjson", etag)
+
+
+@app.route("/v1/changed", methods=["POST"])
+def changed_entries():
+    realm = get_realm()
+    ensure_realm_loaded(realm)
+    if not request.json or not "hashes" in request.json or not "token" in request.json:
+        return jsonify({"success": False, "reason": "invalid_request", "message": "Invalid request"})
+    ok, reason = check_token(request.json["token"], "write")
+    if not ok:
+        return jsonify(reason)
+
+    state = realm_state()
+    changed = []
+    for (key, digest) in request.json["hashes"]:
+        existing = state.lookup(key)
+        if not existing or entry_hash(existing) != digest:
+            changed.append(key)
+    return jsonify({"success": True, "changed": changed})
+
+
+@app.route("/v1/resolve", methods=["POST"])
+def resolve():
+    realm = get_realm()
+    ensure_realm_loaded(realm)
+    if not request.json or not "keys" in request.json or not "token" in request.json:
+        return jsonify({"success": False, "reason": "invalid_request", "message": "Invalid request"})
+    ok, reason = check_token(request.json["token"], "read")
+    if not ok:
+        return jsonify(reason)
+
+    rejects = []
+    dups = []
+    if "entries" in request.json:
+        ok, reason = check_token(request.json["token"], "write")
+        if not ok:
+            return jsonify(reason)
+        rejects, dups = update_entries(request.json["entries"], request.json["token"])
+
+    known = request.json.get("known", {})
+    entries = [fetch_entry(key, known) for key in request.json["keys"]]
+    result = {"success": True, "entries": entries, "rejects": rejects, "duplicates": dups, "suggestions": {}, "revision": realm_revision()}
+    unresolved = [key for (key, entry) in zip(request.json["keys"], entries) if not entry and not '#' in key]
+    if len(unresolved) > 0:
+        ok, reason = check_token(request.json["token"], "search")
+        if not ok:
+            result["suggest_error"] = reason
+        else:
+            for key in unresolved:
+                result["suggestions"][key] = suggest_keys(key)
+    return encoded_response([app.json.dumps(result)], "application/json")
+
+
 @app.route("/v1/sync", methods=["GET"])
 def sync():
-    global repo, bib_database, token_db, tokens
     realm = get_realm()
     ensure_realm_loaded(realm)
-    parser = BibTexParser(common_strings=True)
-    parser.ignore_nonstandard_types = False
-    parser.homogenize_fields = True
-    import os
+    with realm_lock(realm):
+        sync_realm(realm)
+    schedule_eviction(realm)
+    return "Synced!"
+
+
+def sync_realm(realm):
+    """Pulls the realm and publishes its new state, the caller holds the realm lock."""
+    global tokens
+    load_missing_realm(realm)
     realm_dir = os.path.join(repo_path, realm)
+    pipeline = write_pipeline(realm)
+    old_head = None
     try:
-        repo[realm] = git.Repo(realm_dir)
-        origin = repo[realm].remotes.origin
-        origin.pull()
-    except:
-        print("Warning: could not pull from repository")
-    bib_path = os.path.join(realm_dir, repo_name)
-    try:
-        with open(bib_path) as bibtex_file:
-            bib_database[realm] = bibtexparser.load(bibtex_file, parser)
-    except Exception:
-        bib_database[realm] = bibtexparser.bibdatabase.BibDatabase()
+        # everything is committed, so the pull rebases the realm's commits onto the remote ones
+        compact_journal(realm)
+        pipeline.flush()
+        with pipeline.git_lock:
+            repo[realm] = git.Repo(realm_dir)
+            old_head = repo[realm].head.commit.hexsha
+            try:
+                repo[realm].git.pull("--rebase")
+            except git.GitCommandError:
+                # a conflict with the remote, the realm keeps its commits and stays as it is
+                if os.path.isdir(os.path.join(repo[realm].git_dir, "rebase-merge")) or os.path.isdir(os.path.join(repo[realm].git_dir, "rebase-apply")):
+                    repo[realm].git.rebase("--abort")
+                raise
+    except Exception as e:
+        print("Warning: could not pull from repository (%s)" % e)
+    state = None
+    if realm in realms and old_head:
+        try:
+            state = sync_entries(realm, realms[realm], old_head)
+        except Exception as e:
+            print("Warning: could not sync changed entries (%s)" % e)
+    if state is None:
+        state = read_realm_state(realm, realms.get(realm))
+    publish_state(realm, state)
     tokens_path = os.path.join(realm_dir, "tokens.json")
     try:
         with open(tokens_path) as tdb:
@@ -405,7 +2208,8 @@ def sync():
     except:
         print("Error: error in the tokens.json, could not load it!")
         token_db[realm] = {}
-    return "Synced!"
+    if pipeline.unpushed > 0:
+        pipeline.push(rebase=False)
 
 
 @app.route("/v1/webhook", methods=["POST"])
@@ -423,68 +2227,551 @@ def webhook():
             break
 
     if not was_internal:
-        return sync()
+        schedule_reload(get_realm())
+        return "Sync queued"
     else:
         return "OK"
 
 
+def schedule_reload(realm):
+    with reloads_lock:
+        pending = realm in reloads
+        reloads[realm] = reloads.get(realm, 0) + 1
+    if not pending:
+        # the journal is committed right away, so the reload rebases the writes onto the pushed commits
+        timer = threading.Timer(0, commit_realm, [realm])
+        timer.daemon = True
+        timer.start()
+        timer = threading.Timer(reload_window, reload_realm, [realm])
+        timer.daemon = True
+        timer.start()
+
+
+def commit_realm(realm):
+    try:
+        compact_journal(realm)
+        with pipelines_lock:
+            pipeline = pipelines.get(realm)
+        if pipeline:
+            pipeline.flush()
+    except Exception as e:
+        print("Error: could not commit realm %s (%s)" % (realm, e))
+
+
+def reload_realm(realm):
+    with reloads_lock:
+        count = reloads.pop(realm, 0)
+    print("Reloading realm %s for %d webhook(s)" % (realm, count))
+    try:
+        with realm_lock(realm):
+            sync_realm(realm)
+    except Exception as e:
+        print("Error: could not reload realm %s (%s)" % (realm, e))
+    schedule_eviction(realm)
+
+
 @app.route("/v1/version", methods=["GET"])
 def version():
-    return jsonify({"version": VERSION, "url": "client.py"})
+    result = {"version": VERSION, "url": "client.py", "features": ["resolve", "changed", "revision"]}
+    if "token" in request.args:
+        ok, _ = check_token(request.args["token"], "read")
+        if ok:
+            result["revision"] = realm_revision()
+    return jsonify(result)
+
+
+def monitor_access():
+    if not monitor_token:
+        return False
+    given = request.headers.get("Authorization", "").encode("utf-8")
+    return hmac.compare_digest(given, ("Bearer " + monitor_token).encode("utf-8"))
+
+
+def realm_status(realm, pipeline):
+    result = pipeline.status() if pipeline else {}
+    result["loaded"] = realm in realms
+    result["resident_size"] = realm_sizes.get(realm)
+    result["last_access"] = realm_usage.get(realm)
+    result["pending_reloads"] = reloads.get(realm, 0)
+    result["journal_writes"] = len(journals.get(realm, []))
+    with imports_lock:
+        if realm in imports:
+            result["import"] = dict(imports[realm])
+    return result
+
+
+def policy_status():
+    with policy_stats_lock:
+        return {name: dict(stats) for (name, stats) in policy_stats.items()}
+
+
+@app.route("/v1/status", methods=["GET"])
+def status():
+    with realm_usage_lock:
+        cache = dict(realm_counters)
+        cache["loaded_realms"] = len(realms)
+        cache["resident_size"] = sum(realm_sizes.get(realm, 0) for realm in realms)
+    cache["max_realms"] = max_realms
+    cache["max_memory"] = max_memory
+    if not monitor_access():
+        return jsonify({"cache": cache})
+    with pipelines_lock:
+        active = dict(pipelines)
+    result = {}
+    for realm in set(active) | set(realms) | set(reloads) | set(imports):
+        result[realm] = realm_status(realm, active.get(realm))
+    return jsonify({"realms": result, "cache": cache, "policies": policy_status()})
+
+
+@app.route("/v1/status/<string:token>", methods=["GET"])
+@app.route("/v1/status/<string:token>/<string:realm>", methods=["GET"])
+def status_of_realm(token, realm=None):
+    realm = get_realm()
+    ok, reason = check_token(token, "status")
+    if not ok:
+        return jsonify(reason)
+    with pipelines_lock:
+        pipeline = pipelines.get(realm)
+    return jsonify({"success": True, "status": realm_status(realm, pipeline), "policies": policy_status()})
+
+
+def metric_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for (name, value) in labels)
+
+
+@app.route("/v1/metrics", methods=["GET"])
+def metrics():
+    lines = []
+    hidden = [] if monitor_access() else ["realm", "policy"]
+
+    def visible(values):
+        merged = {}
+        for (labels, value) in values.items():
+            labels = tuple(label for label in labels if label[0] not in hidden)
+            if labels not in merged:
+                merged[labels] = value
+            elif isinstance(value, list):
+                merged[labels] = [a + b for (a, b) in zip(merged[labels], value)]
+            else:
+                merged[labels] += value
+        return merged
+
+    def metric(name, kind, description, values):
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for (labels, value) in sorted(visible(values).items()):
+            lines.append("%s%s %s" % (name, metric_labels(labels), repr(value)))
+
+    descriptions = {
+        "bibtool_entries_scanned_total": "Entries compared with a request, by operation",
+        "bibtool_levenshtein_comparisons_total": "Field comparisons with Levenshtein distance in duplicate checks",
+        "bibtool_push_failures_total": "Failed pushes to the remote repository",
+        "bibtool_request_seconds": "Time to answer a request, including streaming the response",
+        "bibtool_phase_seconds": "Time spent in one phase of a request: parse_json, duplicates, policy, render, write, commit, push",
+    }
+    with metrics_lock:
+        counters = {name: dict(values) for (name, values) in metric_counters.items()}
+        histograms = {name: {labels: list(value) for (labels, value) in values.items()} for (name, values) in metric_histograms.items()}
+    for (name, values) in sorted(counters.items()):
+        metric(name, "counter", descriptions.get(name, name), values)
+    for (name, values) in sorted(histograms.items()):
+        lines.append("# HELP %s %s" % (name, descriptions.get(name, name)))
+        lines.append("# TYPE %s histogram" % name)
+        for (labels, value) in sorted(visible(values).items()):
+            cumulative = 0
+            for (bound, observed) in zip(HISTOGRAM_BUCKETS + ["+Inf"], value):
+                cumulative += observed
+                lines.append("%s_bucket%s %d" % (name, metric_labels(labels + (("le", str(bound)), )), cumulative))
+            lines.append("%s_sum%s %s" % (name, metric_labels(labels), repr(value[-2])))
+            lines.append("%s_count%s %d" % (name, metric_labels(labels), value[-1]))
+
+    with pipelines_lock:
+        active = dict(pipelines)
+    states = dict(realms)
+    metric("bibtool_realm_entries", "gauge", "Entries of each loaded realm",
+           {(("realm", realm), ): len(state.db.entries) for (realm, state) in states.items()})
+    metric("bibtool_realm_resident_bytes", "gauge", "Estimated memory of each loaded realm",
+           {(("realm", realm), ): realm_sizes.get(realm, 0) for realm in states})
+    statuses = {realm: pipeline.status() for (realm, pipeline) in active.items()}
+    metric("bibtool_unpushed_commits", "gauge", "Commits not pushed yet",
+           {(("realm", realm), ): status["unpushed_commits"] for (realm, status) in statuses.items()})
+    metric("bibtool_pending_writes", "gauge", "Writes not committed yet",
+           {(("realm", realm), ): status["pending_writes"] for (realm, status) in statuses.items()})
+    with realm_usage_lock:
+        cache = dict(realm_counters)
+    for (name, value) in sorted(cache.items()):
+        metric("bibtool_realm_cache_%s_total" % name, "counter", "Realm cache %s" % name, {(): value})
+    with policy_stats_lock:
+        stats = {name: dict(values) for (name, values) in policy_stats.items()}
+    for field in ["calls", "entries", "rejects", "timeouts", "skipped", "seconds"]:
+        metric("bibtool_policy_%s_total" % field, "counter", "Policy %s" % field,
+               {(("policy", name), ): values[field] for (name, values) in stats.items()})
+    metric("bibtool_policy_running", "gauge", "Policy calls still running, also after their timeout",
+           {(("policy", name), ): values["running"] for (name, values) in stats.items()})
+    metric("bibtool_policy_overrunning", "gauge", "Policy calls still running after their timeout",
+           {(("policy", name), ): values["overrunning"] for (name, values) in stats.items()})
+    return app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/v1/profiles/<string:token>", methods=["GET"])
+@app.route("/v1/profiles/<string:token>/<string:realm>", methods=["GET"])
+def list_profiles(token, realm=None):
+    realm = get_realm()
+    ok, reason = check_token(token, "profile")
+    if not ok:
+        return jsonify(reason)
+    with profile_lock:
+        found = [{key: value for (key, value) in profile.items() if key != "data"} for profile in profiles.values() if profile["realm"] == realm]
+        sampling = {endpoint: {"samples": samples, "every": every} for ((name, endpoint), (samples, every)) in profile_sampling.items() if name == realm}
+    return jsonify({"success": True, "profiles": found, "sampling": sampling})
+
+
+@app.route("/v1/profile/<string:profile_id>/<string:token>", methods=["GET"])
+@app.route("/v1/profile/<string:profile_id>/<string:token>/<string:realm>", methods=["GET"])
+def get_profile(profile_id, token, realm=None):
+    realm = get_realm()
+    ok, reason = check_token(token, "profile")
+    if not ok:
+        return jsonify(reason)
+    with profile_lock:
+        profile = profiles.get(profile_id)
+    if not profile or profile["realm"] != realm:
+        return jsonify({"success": False, "reason": "not_found", "message": "There is no profile %s" % profile_id})
+    if request.args.get("format") != "text":
+        response = app.response_class(profile["data"], mimetype="application/octet-stream")
+        response.headers["Content-Disposition"] = "attachment; filename=%s.prof" % profile_id
+        return response
+    try:
+        limit = int(request.args.get("limit", "50"))
+    except ValueError:
+        return jsonify({"success": False, "reason": "invalid_request", "message": "limit has to be a number"})
+    with tempfile.NamedTemporaryFile(suffix=".prof") as f:
+        f.write(profile["data"])
+        f.flush()
+        report = io.StringIO()
+        stats = pstats.Stats(f.name, stream=report)
+        stats.sort_stats("cumulative").print_stats(limit)
+    return app.response_class(report.getvalue(), mimetype="text/plain")
+
+
+@app.route("/v1/profile/sampling", methods=["POST"])
+def profile_sampling_config():
+    realm = get_realm()
+    if not request.json or not "token" in request.json or not "endpoint" in request.json:
+        return jsonify({"success": False, "reason": "invalid_request", "message": "Invalid request"})
+    ok, reason = check_token(request.json["token"], "profile")
+    if not ok:
+        return jsonify(reason)
+    endpoint = request.json["endpoint"]
+    if endpoint not in app.view_functions:
+        return jsonify({"success": False, "reason": "invalid_request", "message": "There is no endpoint %s" % endpoint})
+    try:
+        samples = int(request.json.get("samples", 1))
+        every = int(request.json.get("every", 1))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "reason": "invalid_request", "message": "samples and every have to be numbers"})
+    with profile_lock:
+        if samples <= 0:
+            profile_sampling.pop((realm, endpoint), None)
+        else:
+            profile_sampling[(realm, endpoint)] = (samples, max(every, samples))
+            profile_requests[(realm, endpoint)] = 0
+    return jsonify({"success": True})
+
+
+def estimate_size(state):
+    size = 0
+    for entry in state.db.entries:
+        size += sys.getsizeof(entry) + sum(sys.getsizeof(value) for value in entry.values())
+    for index in [state.dups, state.search, state.suggest, state.render]:
+        for table in vars(index).values():
+            if not isinstance(table, (dict, set, list)):
+                continue
+            size += sys.getsizeof(table)
+            if isinstance(table, dict):
+                for value in table.values():
+                    if isinstance(value, (dict, set, list, tuple)):
+                        # the values are mostly ids of entries
+                        size += sys.getsizeof(value) + 32 * len(value)
+    return size
+
+
+def entry_size(entry):
+    return sys.getsizeof(entry) + sum(sys.getsizeof(value) + 32 * len(value) for value in entry.values())
 
 
 def ensure_realm_loaded(realm):
-    # Only load if not already loaded
-    if realm in repo and realm in bib_database and realm in token_db:
+    """Loads the realm unless it is in memory, and marks it as used until the request ends."""
+    in_use = g.setdefault("realms_in_use", set())
+    g.setdefault("metrics_realm", realm)
+    with realm_usage_lock:
+        first_use = realm not in in_use
+        if first_use:
+            in_use.add(realm)
+            realm_users[realm] = realm_users.get(realm, 0) + 1
+        if realm in realms:
+            realm_usage[realm] = time.time()
+            realm_usage.move_to_end(realm)
+            if first_use:
+                realm_counters["hits"] += 1
+            return
+    load_missing_realm(realm)
+    schedule_eviction(realm)
+
+
+def load_missing_realm(realm):
+    with realm_lock(realm):
+        if realm not in realms:
+            load_realm(realm)
+            with realm_usage_lock:
+                realm_counters["misses"] += 1
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    if request.method in ["POST", "PUT"] and request.is_json:
+        start = time.perf_counter()
+        data = request.get_json(silent=True)
+        realm = data.get("realm", default_realm) if isinstance(data, dict) else default_realm
+        observe("bibtool_phase_seconds", time.perf_counter() - start, phase="parse_json", realm=realm)
+
+
+def profile_requested():
+    if profile_sampling and request.endpoint is not None:
+        key = (get_realm(), request.endpoint)
+        with profile_lock:
+            if key in profile_sampling:
+                samples, every = profile_sampling[key]
+                number = profile_requests.get(key, 0)
+                profile_requests[key] = number + 1
+                if number % every < samples:
+                    return True
+    data = request.get_json(silent=True) if request.is_json else None
+    data = data if isinstance(data, dict) else {}
+    if request.args.get("profile") not in ["1", "true"] and data.get("profile") is not True:
+        return False
+    token = (request.view_args or {}).get("token") or data.get("token")
+    return check_token(token, "profile")[0]
+
+
+@app.before_request
+def start_profile():
+    if not profile_requested():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is active, since Python 3.12 also one of a concurrent request
+        return
+    g.profiler = profiler
+    g.profile_id = "%d-%s" % (int(time.time() * 1000), os.urandom(4).hex())
+
+
+def store_profile():
+    profiler = g.pop("profiler")
+    profiler.disable()
+    profiler.create_stats()
+    profile = {
+        "id": g.profile_id,
+        "time": time.time(),
+        "endpoint": request.endpoint,
+        "path": request.path,
+        "realm": g.get("metrics_realm", ""),
+        "seconds": time.perf_counter() - g.request_start,
+        # since Python 3.12, a profiler sees the calls of all threads, not only of this request
+        "all_threads": profile_all_threads,
+        "data": marshal.dumps(profiler.stats),
+    }
+    with profile_lock:
+        profiles[profile["id"]] = profile
+        while len(profiles) > profile_retention:
+            profiles.popitem(last=False)
+
+
+@app.after_request
+def remember_status(response):
+    g.status = response.status_code
+    if "profile_id" in g:
+        response.headers["X-BibTool-Profile"] = g.profile_id
+    return response
+
+
+@app.teardown_request
+def finish_request(exception=None):
+    if g.pop("streaming", False):
+        # called again once the streamed response is sent
+        return
+    if "request_start" not in g:
+        return
+    if "profiler" in g:
+        store_profile()
+    observe("bibtool_request_seconds", time.perf_counter() - g.request_start, endpoint=request.endpoint or "none",
+            method=request.method, realm=g.get("metrics_realm", ""), status=str(g.get("status", 500)))
+
+
+@app.teardown_request
+def release_realms(exception=None):
+    with realm_usage_lock:
+        for realm in g.pop("realms_in_use", ()):
+            realm_users[realm] -= 1
+
+
+def over_budget():
+    with realm_usage_lock:
+        if max_realms > 0 and len(realms) > max_realms:
+            return True
+        return max_memory > 0 and sum(realm_sizes.get(realm, 0) for realm in realms) > max_memory
+
+
+def schedule_eviction(keep):
+    """Evicts realms in the background thread, so a request does not commit or push another realm."""
+    global eviction_thread
+    if not over_budget():
+        return
+    with eviction_cond:
+        eviction_requests.append(keep)
+        if eviction_thread is None:
+            eviction_thread = threading.Thread(target=run_evictions, name="eviction", daemon=True)
+            eviction_thread.start()
+        eviction_cond.notify()
+
+
+def run_evictions():
+    while True:
+        with eviction_cond:
+            while len(eviction_requests) == 0:
+                eviction_cond.wait()
+            keep = eviction_requests[-1]
+            del eviction_requests[:]
+        try:
+            evict_realms(keep)
+        except Exception as e:
+            print("Error: could not evict realms (%s)" % e)
+
+
+def evict_realms(keep):
+    if not over_budget():
         return
-    import os
+    with realm_usage_lock:
+        candidates = [realm for realm in realm_usage if realm != keep]
+    for realm in candidates:
+        evict_realm(realm)
+        if not over_budget():
+            return
+
+
+def evict_realm(realm):
+    """Drops an idle realm from memory once its writes are committed and pushed."""
+    with realm_usage_lock:
+        if realm_users.get(realm, 0) > 0 or realm not in realms:
+            return False
+    compact_journal(realm)
+    with pipelines_lock:
+        pipeline = pipelines.get(realm)
+    if pipeline:
+        pipeline.flush(push=True)
+    write_snapshot(realm)
+    lock = realm_lock(realm)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        # a realm written to meanwhile, or whose push failed, stays loaded and its pipeline retries the push
+        with journals_lock:
+            if realm in journals:
+                return False
+        if pipeline and not pipeline.idle():
+            return False
+        with realm_usage_lock:
+            # requests only take a realm that is in realms, so it is unused from here on
+            if realm_users.get(realm, 0) > 0:
+                return False
+            del realms[realm]
+            realm_usage.pop(realm, None)
+            realm_sizes.pop(realm, None)
+            realm_counters["evictions"] += 1
+        if pipeline:
+            pipeline.close()
+            with pipelines_lock:
+                pipelines.pop(realm, None)
+        if repo.get(realm):
+            repo[realm].close()
+        repo.pop(realm, None)
+        token_db.pop(realm, None)
+        return True
+    finally:
+        lock.release()
+
+
+def exclude_journal(repository):
+    """Hides the journal from git status."""
+    path = os.path.join(repository.git_dir, "info", "exclude")
+    try:
+        with open(path) as exclude_file:
+            content = exclude_file.read()
+    except FileNotFoundError:
+        content = ""
+    name = "/." + repo_name + ".journal"
+    if name in content.splitlines():
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as exclude_file:
+        exclude_file.write(("\n" if content and not content.endswith("\n") else "") + name + "\n")
+
+
+def load_realm(realm):
     from pathlib import Path
     global repo_path, repo_name
     realm_dir = os.path.join(repo_path, realm)
     Path(realm_dir).mkdir(parents=True, exist_ok=True)
-    bib_path = os.path.join(realm_dir, repo_name)
     tokens_path = os.path.join(realm_dir, "tokens.json")
     # Load repo
     try:
         repo[realm] = git.Repo(realm_dir)
+        exclude_journal(repo[realm])
     except Exception:
         repo[realm] = None
-    # Load bib database
-    parser = BibTexParser(common_strings=True)
-    parser.ignore_nonstandard_types = False
-    parser.homogenize_fields = True
-    try:
-        with open(bib_path) as bibtex_file:
-            bib_database[realm] = bibtexparser.load(bibtex_file, parser)
-    except Exception:
-        bib_database[realm] = bibtexparser.bibdatabase.BibDatabase()
     # Load tokens
     try:
         with open(tokens_path) as tdb:
             token_db[realm] = json.load(tdb)
     except Exception:
         token_db[realm] = {}
+    state = read_realm_state(realm)
+    # the state is published last, it marks the realm as loaded
+    with realm_usage_lock:
+        realm_sizes[realm] = state.size
+        realm_usage[realm] = time.time()
+        realms[realm] = state
 
 
 if __name__ == "__main__":
-    global repo_path, repo_name, policy, default_realm
+    global repo_path, repo_name
 
     if len(sys.argv) < 3:
-        print("Usage: %s <repo path> <bib filename> [policy] [default realm]" % sys.argv[0])
+        print("Usage: %s <repo path> <bib filename> [policy[,policy...]] [default realm]" % sys.argv[0])
         sys.exit(1)
     repo_path = sys.argv[1]
     repo_name = sys.argv[2]
     if len(sys.argv) > 3:
-        try:
-            print("Import policy %s" % sys.argv[3])
-            policy = importlib.import_module(sys.argv[3])
-        except:
-            policy = None
-    else:
-        policy = None
+        for name in sys.argv[3].split(","):
+            try:
+                print("Import policy %s" % name)
+                policies.append(importlib.import_module(name))
+            except:
+                pass
     if len(sys.argv) > 4:
         default_realm = sys.argv[4]
+    if not os.path.relpath(os.path.abspath(cache_path), os.path.abspath(repo_path)).startswith(".."):
+        # a pull could check out snapshots that someone committed, which are loaded without checks
+        print("Error: the snapshot cache %s has to be outside of the repositories in %s, set BIBTOOL_CACHE_DIR" % (cache_path, repo_path))
+        sys.exit(1)
 
-    sync()
+    with realm_lock(default_realm):
+        sync_realm(default_realm)
 
-    app.run(debug=False, host='0.0.0.0')
+    app.run(debug=False, host='0.0.0.0', threaded=True)
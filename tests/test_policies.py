@@ -0,0 +1,78 @@
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+server = pytest.importorskip("server")
+bibtexparser = pytest.importorskip("bibtexparser")
+
+
+@pytest.fixture
+def hanging_policy(monkeypatch):
+    release = threading.Event()
+    policy = types.ModuleType("hanging_policy")
+    policy.check_batch = lambda entries, realm: release.wait() and [(True, None)] * len(entries)
+    monkeypatch.setattr(server, "policies", [policy])
+    monkeypatch.setattr(server, "policy_workers", 2)
+    yield release
+    release.set()
+    server.policy_pools.pop("hanging_policy").shutdown(wait=True)
+    server.policy_stats.pop("hanging_policy")
+
+
+def test_stuck_policy_keeps_its_threads_bounded(hanging_policy):
+    state = server.RealmState(bibtexparser.bibdatabase.BibDatabase())
+    entry = {"ENTRYTYPE": "article", "ID": "key", "title": "A Title"}
+    threads = threading.active_count()
+    for _ in range(2):
+        assert server.run_policies([entry], state, time.time() + 0.1) == [(False, "Policy check did not finish in time.")]
+    start = time.time()
+    for _ in range(5):
+        assert server.run_policies([entry], state, time.time() + 0.1) == [(False, "Policy check is not available.")]
+    assert time.time() - start < 0.1
+    assert threading.active_count() == threads + 2
+    stats = server.policy_status()["hanging_policy"]
+    assert (stats["timeouts"], stats["skipped"], stats["overrunning"], stats["running"]) == (2, 5, 2, 2)
+
+    hanging_policy.set()
+    end = time.time() + 5
+    while server.policy_status()["hanging_policy"]["overrunning"] > 0 and time.time() < end:
+        time.sleep(0.01)
+    assert server.run_policies([entry], state, time.time() + 1) == [(True, None)]
+    stats = server.policy_status()["hanging_policy"]
+    assert (stats["overrunning"], stats["running"]) == (0, 0)
+
+
+def test_policy_reads_the_published_state_and_not_the_writer_copy(tmp_path, monkeypatch):
+    seen = []
+    policy = types.ModuleType("recording_policy")
+
+    def check_batch(entries, realm):
+        seen.append((realm, len(realm.entries)))
+        return [(True, None)] * len(entries)
+
+    policy.check_batch = check_batch
+    monkeypatch.setattr(server, "policies", [policy])
+    monkeypatch.setattr(server, "repo_path", str(tmp_path), raising=False)
+    monkeypatch.setattr(server, "repo_name", "main.bib", raising=False)
+    monkeypatch.setattr(server, "compact_delay", 3600)
+    monkeypatch.setattr(server, "tokens", False)
+    (tmp_path / "policies").mkdir()
+    published = server.RealmState(bibtexparser.bibdatabase.BibDatabase())
+    monkeypatch.setitem(server.realms, "policies", published)
+    try:
+        with server.app.test_request_context("/?realm=policies"):
+            server.update_entries([{"ENTRYTYPE": "article", "ID": "key", "title": "A Title"}], None)
+        realm, count = seen[0]
+        # the writer's copy got the entry, the state the policy reads did not change
+        assert realm._state is published and count == 0 and len(realm.entries) == 0
+        assert server.realms["policies"].lookup("key")
+    finally:
+        for table in [server.journals, server.realm_usage, server.realm_users, server.realm_sizes]:
+            table.pop("policies", None)
+        server.policy_stats.pop("recording_policy", None)
+        server.policy_pools.pop("recording_policy").shutdown()
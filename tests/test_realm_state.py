@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+server = pytest.importorskip("server")
+bibtexparser = pytest.importorskip("bibtexparser")
+
+
+def entry(key, title):
+    return {"ENTRYTYPE": "article", "ID": key, "title": title, "author": "Alice Author"}
+
+
+def realm_state(entries):
+    db = bibtexparser.bibdatabase.BibDatabase()
+    db.entries = entries
+    return server.RealmState(db)
+
+
+def test_equal_entries_are_replaced_and_removed_by_identity():
+    first = entry("same", "The Same Title")
+    other = entry("other", "Another Title")
+    second = entry("same", "The Same Title")
+    state = realm_state([first, other, second])
+
+    changed = entry("same", "A Changed Title")
+    state.replace(second, changed)
+    assert state.db.entries[0] is first and state.db.entries[2] is changed
+    renamed = entry("renamed", "The Same Title")
+    state.replace(first, renamed)
+    assert state.db.entries == [other, changed, renamed] and state.db.entries[0] is other
+    state.remove(changed)
+    assert state.db.entries == [other, renamed]
+    assert [e is renamed for e in state.db.entries] == [False, True]
+    assert state.by_key == {"other": [other], "renamed": [renamed]}
+
+
+def test_removing_one_of_two_equal_entries_keeps_the_other():
+    first = entry("same", "The Same Title")
+    second = entry("same", "The Same Title")
+    state = realm_state([first, second])
+    state.remove(second)
+    assert len(state.db.entries) == 1 and state.db.entries[0] is first
+    assert state.lookup("same") is first
+
+
+def test_duplicates_scored_in_processes_match_the_ones_scored_in_the_server(monkeypatch):
+    entries = [entry("key%d" % idx, "A Paper About Topic Number %d" % idx) for idx in range(50)]
+    state = realm_state(entries)
+    upload = [entry("new%d" % idx, "A Paper About Topic Number %d!" % idx) for idx in range(10)]
+    # no title, so it is compared with every entry
+    upload.append({"ENTRYTYPE": "misc", "ID": "key3x", "author": "Alice Author"})
+    with server.app.test_request_context("/"):
+        serial = server.batch_duplicates(upload, state)
+        monkeypatch.setattr(server, "duplicate_workers", 2)
+        monkeypatch.setattr(server, "parallel_duplicates", 0)
+        try:
+            parallel = server.batch_duplicates(upload, state)
+        finally:
+            server.duplicate_pool.shutdown()
+            monkeypatch.setattr(server, "duplicate_pool", None)
+    assert parallel == serial
+    assert all(len(found) > 0 for found in serial[:10])
@@ -0,0 +1,201 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+server = pytest.importorskip("server")
+
+REALM = "realm"
+ENTRY = "@article{%s,\n title = {%s},\n author = {%s}\n}\n"
+
+
+def git(cwd, *args):
+    return subprocess.run(["git"] + list(args), cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def clone(remote, path):
+    git(os.path.dirname(path), "clone", "-q", remote, path)
+    git(path, "config", "user.email", "bib@to.ol")
+    git(path, "config", "user.name", "BibTool")
+
+
+def remote_bib(other):
+    git(other, "pull", "-q", "--rebase")
+    with open(os.path.join(other, "main.bib")) as bib_file:
+        return bib_file.read()
+
+
+def push_entry(other, key, title, author):
+    git(other, "pull", "-q", "--rebase")
+    with open(os.path.join(other, "main.bib"), "a") as bib_file:
+        bib_file.write("\n" + ENTRY % (key, title, author))
+    git(other, "commit", "-qam", "Add %s by hand" % key)
+    git(other, "push", "-q")
+
+
+@pytest.fixture
+def realm(tmp_path, monkeypatch):
+    remote = str(tmp_path / "remote.git")
+    git(str(tmp_path), "init", "-q", "--bare", remote)
+    seed = str(tmp_path / "seed")
+    clone(remote, seed)
+    with open(os.path.join(seed, "main.bib"), "w") as bib_file:
+        bib_file.write(ENTRY % ("first", "The First Entry of the Realm", "Alice Author"))
+    git(seed, "add", "main.bib")
+    git(seed, "commit", "-qm", "Initial")
+    git(seed, "push", "-q", "origin", "HEAD")
+    repos = tmp_path / "repos"
+    repos.mkdir()
+    clone(remote, str(repos / REALM))
+    other = str(tmp_path / "other")
+    clone(remote, other)
+
+    monkeypatch.setattr(server, "repo_path", str(repos), raising=False)
+    monkeypatch.setattr(server, "repo_name", "main.bib", raising=False)
+    monkeypatch.setattr(server, "cache_path", str(tmp_path / "cache"))
+    monkeypatch.setattr(server, "tokens", False)
+    monkeypatch.setattr(server, "default_realm", REALM)
+    # nothing is folded, committed or reloaded by a timer while a test runs
+    monkeypatch.setattr(server, "compact_delay", 3600)
+    monkeypatch.setattr(server, "commit_window", 3600)
+    monkeypatch.setattr(server, "reload_window", 3600)
+    monkeypatch.setattr(server, "snapshot_delay", 3600)
+    yield other
+    for pipeline in list(server.pipelines.values()):
+        pipeline.close()
+    for table in [server.realms, server.repo, server.pipelines, server.journals, server.folded, server.token_db,
+                  server.realm_usage, server.realm_users, server.realm_sizes, server.snapshots, server.reloads]:
+        table.clear()
+
+
+def add_entry(client, key, title, author):
+    response = client.post("/v1/entry/%s" % key, json={"token": "none", "entry": {"ENTRYTYPE": "article", "ID": key, "title": title, "author": author}})
+    assert response.get_json() == {"success": True}
+
+
+def wait_for(condition, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_sync_rebases_unpushed_writes_onto_a_manual_push(realm):
+    client = server.app.test_client()
+    add_entry(client, "second", "An Entry Written Through the Server", "Bob Writer")
+    pipeline = server.write_pipeline(REALM)
+    with pipeline.cond:
+        # the push of the write is still waiting, e.g. in its backoff
+        pipeline.next_push = time.time() + 3600
+    push_entry(realm, "third", "An Entry Pushed by Hand", "Carol Committer")
+
+    with server.realm_lock(REALM):
+        server.sync_realm(REALM)
+
+    assert pipeline.unpushed == 0
+    content = remote_bib(realm)
+    assert "{second," in content and "{third," in content
+    state = server.realms[REALM]
+    assert state.lookup("second") and state.lookup("third")
+    assert "[BibTool] Added second" in git(realm, "log", "--format=%s")
+
+
+def test_rejected_push_rebases_and_pushes_again(realm):
+    client = server.app.test_client()
+    client.get("/v1/sync")
+    push_entry(realm, "third", "An Entry Pushed by Hand", "Carol Committer")
+    add_entry(client, "second", "An Entry Written Through the Server", "Bob Writer")
+    server.compact_journal(REALM)
+    pipeline = server.write_pipeline(REALM)
+    # committed before the pipeline thread pushes it, which is rejected by the remote
+    pipeline.flush()
+
+    assert wait_for(lambda: pipeline.unpushed == 0)
+    assert pipeline.push_failures == 0
+    content = remote_bib(realm)
+    assert "{second," in content and "{third," in content
+    assert server.realms[REALM].lookup("third")
+
+
+def test_webhook_commits_the_journal_in_the_background_before_the_reload(realm):
+    client = server.app.test_client()
+    add_entry(client, "second", "An Entry Written Through the Server", "Bob Writer")
+    assert REALM in server.journals
+    push_entry(realm, "third", "An Entry Pushed by Hand", "Carol Committer")
+
+    response = client.post("/v1/webhook", json={"commits": [{"message": "Add third by hand"}]})
+    assert response.get_data(as_text=True) == "Sync queued"
+    assert server.reloads[REALM] == 1
+    # committed in the background, long before the reload
+    local = os.path.join(server.repo_path, REALM)
+    assert wait_for(lambda: git(local, "log", "-1", "--format=%s") == "[BibTool] Added second\n")
+    assert REALM not in server.journals
+
+    server.reload_realm(REALM)
+    assert server.write_pipeline(REALM).unpushed == 0
+    content = remote_bib(realm)
+    assert "{second," in content and "{third," in content
+    assert server.realms[REALM].lookup("third")
+
+
+def test_eviction_pushes_the_writes_of_the_evicted_realm(realm, monkeypatch):
+    monkeypatch.setattr(server, "max_realms", 1)
+    client = server.app.test_client()
+    add_entry(client, "second", "An Entry Written Through the Server", "Bob Writer")
+    client.get("/v1/entry/first?realm=unrelated")
+
+    assert wait_for(lambda: REALM not in server.realms)
+    assert REALM not in server.pipelines
+    assert "{second," in remote_bib(realm)
+
+
+def test_eviction_keeps_a_realm_whose_push_fails(realm, monkeypatch):
+    monkeypatch.setattr(server, "max_realms", 1)
+    client = server.app.test_client()
+    add_entry(client, "second", "An Entry Written Through the Server", "Bob Writer")
+    git(os.path.join(server.repo_path, REALM), "remote", "set-url", "origin", os.path.join(realm, "missing.git"))
+    client.get("/v1/entry/first?realm=unrelated")
+
+    assert wait_for(lambda: REALM in server.pipelines and server.pipelines[REALM].push_failures > 0)
+    pipeline = server.pipelines[REALM]
+    server.evict_realms("unrelated")
+    assert REALM in server.realms and server.pipelines[REALM] is pipeline
+    assert pipeline.unpushed == 1
+
+
+def test_reload_syncs_a_realm_outside_of_a_request(realm):
+    push_entry(realm, "third", "An Entry Pushed by Hand", "Carol Committer")
+    # the timer of schedule_reload() runs it in a thread of its own, without a request
+    thread = threading.Thread(target=server.reload_realm, args=[REALM])
+    thread.start()
+    thread.join()
+
+    assert server.realms[REALM].lookup("third")
+    assert REALM in server.realm_usage
+
+
+def test_export_needs_the_export_permission(realm, monkeypatch):
+    monkeypatch.setattr(server, "tokens", True)
+    with open(os.path.join(server.repo_path, REALM, "tokens.json"), "w") as tokens_file:
+        tokens_file.write('{"reader": {"read": true}, "admin": {"read": true, "export": true}}')
+    client = server.app.test_client()
+
+    assert client.get("/v1/export/reader").get_json()["reason"] == "access_denied"
+    response = client.get("/v1/export/admin?format=ndjson")
+    assert response.get_data(as_text=True).count("\n") == 1 and '"ID": "first"' in response.get_data(as_text=True)
+
+
+def test_import_commit_message_counts_the_added_entries(realm):
+    client = server.app.test_client()
+    upload = ENTRY % ("first", "The First Entry of the Realm", "Alice Author") + "\n" + ENTRY % ("second", "An Imported Entry", "Bob Writer")
+    response = client.post("/v1/import/none", data=upload)
+    assert json.loads(response.get_data(as_text=True).splitlines()[-1])["added"] == 1
+
+    assert server.journals[REALM] == ["Imported 1 entries"]